@@ -0,0 +1,75 @@
+import queue
+import threading
+import tkinter as tk
+
+from artifacts import ArtifactCache
+from controller import Controller
+from metrics import METRICS
+from model import Model
+from history import QuoteHistory
+from partitions import load_listings
+from quote_cache import QuoteCache
+from view import View
+
+
+class App(tk.Tk):
+    def __init__(self, metrics=False, path='carvana.csv', history_path='quote_history.csv'):
+        super().__init__()
+        self.title('Car sale price generator')
+        # Record stage timings and cache counters, shown by the Metrics button
+        METRICS.enable(metrics)
+        # create a model, whose prediction models are trained in the background once the window is up
+        model = Model(load_listings(path), cache=ArtifactCache('model_cache'), quote_cache=QuoteCache())
+        self.model = model
+        # create a view and place it on the root window
+        view = View(self)
+        self.geometry("1050x1050")
+        view.grid(row=0, column=0, padx=30, pady=20)
+        # create a controller
+        controller = Controller(model, view, QuoteHistory(history_path))
+        # set the controller to view
+        view.set_controller(controller)
+        # populate combo boxes with data from csv
+        # year
+        view.populate_combobox(model.get_years(), view.year_menu)
+        # make
+        controller.load_makes()
+        # Quotes of earlier sessions
+        controller.load_history()
+        # Show a graph
+        view.graph_one_button_clicked()
+        self.view = view
+
+        # Train on another thread, which reports its progress through a queue polled by the Tk event loop. Makes are
+        # quotable as soon as their models are ready.
+        self.progress = queue.Queue()
+        model.begin_training()
+        view.show_status("Training models: 0 of " + str(len(model.get_all_makes())) + " makes")
+        self.training_thread = threading.Thread(target=self.train_models, daemon=True)
+        self.training_thread.start()
+        self.after(100, self.poll_training)
+
+    def train_models(self):
+        # Runs on the training thread, which must not touch any widget
+        try:
+            self.model.generate_gradient_boost_model(lambda done, total: self.progress.put(('progress', done, total)))
+            self.progress.put(('done',))
+        except Exception as error:
+            self.progress.put(('error', str(error)))
+
+    def poll_training(self):
+        # Show the latest progress of the training thread and check again until it has finished
+        while True:
+            try:
+                message = self.progress.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                self.view.show_status("Training models: " + str(message[1]) + " of " + str(message[2]) + " makes")
+            elif message[0] == 'done':
+                self.view.show_status("Models ready")
+                return
+            else:
+                self.view.show_status("Training failed: " + message[1])
+                return
+        self.after(100, self.poll_training)
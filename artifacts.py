@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+
+from metrics import METRICS
+from validation import INSUFFICIENT_ERROR, input_error, whole_number
+
+
+def replace_file(path, mode, write):
+    # Write a file through a temporary file of its own in the same directory and move it over path, so an interrupted
+    # write never leaves a truncated file and processes sharing the directory never write to the same temporary file
+    temporary = tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path) or '.',
+                                            prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False)
+    try:
+        with temporary:
+            write(temporary)
+        os.replace(temporary.name, path)
+    except BaseException:
+        if os.path.exists(temporary.name):
+            os.remove(temporary.name)
+        raise
+
+
+class ArtifactCache:
+    # Directory of serialized per make prediction models. Each artifact is saved with a fingerprint of the make's
+    # cleaned rows and the training settings, so it is only reloaded while both are unchanged.
+    manifest_name = 'manifest.json'
+
+    def __init__(self, directory, read_only=False):
+        self.directory = directory
+        # A read only cache reloads artifacts but never saves them, for processes that share a cache another process
+        # keeps up to date
+        self.read_only = read_only
+        self.manifest = {'dataset': None, 'artifacts': {}}
+        # Count the artifacts that were reloaded and the ones that had to be trained again
+        self.hits = 0
+        self.misses = 0
+        path = os.path.join(directory, self.manifest_name)
+        if os.path.exists(path):
+            try:
+                with open(path) as manifest_file:
+                    self.manifest = json.load(manifest_file)
+            except (OSError, ValueError):
+                # A damaged manifest means every make is retrained
+                pass
+
+    @staticmethod
+    def fingerprint_makes(car_data, settings):
+        # Hash the rows of every make together with the training settings
+        import pandas as pd
+        settings_key = json.dumps(settings, sort_keys=True, default=str).encode()
+        row_hashes = pd.util.hash_pandas_object(car_data.drop(columns=['Make']), index=False).to_numpy()
+        fingerprints = {}
+        for make, rows in car_data.groupby('Make', sort=False, observed=True).indices.items():
+            digest = hashlib.sha256(settings_key)
+            digest.update(row_hashes[rows].tobytes())
+            fingerprints[make] = digest.hexdigest()
+        return fingerprints
+
+    @staticmethod
+    def fingerprint_dataset(fingerprints):
+        # Combine the per make fingerprints into one fingerprint for the whole dataset
+        digest = hashlib.sha256()
+        for make in sorted(fingerprints):
+            digest.update(make.encode())
+            digest.update(fingerprints[make].encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def artifact_key(make, with_model):
+        return make + ('|with_model' if with_model else '|without_model')
+
+    def artifact_path(self, make, with_model):
+        # Keep file names readable while stripping characters that are not safe in a path
+        name = re.sub(r'[^A-Za-z0-9_-]', '_', make)
+        return os.path.join(self.directory, name + ('-with_model' if with_model else '-without_model') + '.pkl')
+
+    def load(self, make, with_model, fingerprint):
+        # Return (found, entry). A found entry of None is a make with insufficient data for a prediction model.
+        record = self.manifest['artifacts'].get(ArtifactCache.artifact_key(make, with_model))
+        if record is None or record['fingerprint'] != fingerprint:
+            self.misses += 1
+            METRICS.count('artifact_cache', False)
+            return False, None
+        if not record['trained']:
+            self.hits += 1
+            METRICS.count('artifact_cache', True)
+            return True, None
+        try:
+            with open(self.artifact_path(make, with_model), 'rb') as artifact_file:
+                entry = pickle.load(artifact_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Missing or unreadable artifacts are retrained
+            self.misses += 1
+            METRICS.count('artifact_cache', False)
+            return False, None
+        self.hits += 1
+        METRICS.count('artifact_cache', True)
+        return True, entry
+
+    def save(self, make, with_model, fingerprint, entry):
+        # Serialize a registry entry and record its fingerprint in the manifest
+        if self.read_only:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if entry is not None:
+            replace_file(self.artifact_path(make, with_model), 'wb',
+                         lambda artifact_file: pickle.dump(entry, artifact_file, protocol=pickle.HIGHEST_PROTOCOL))
+        self.manifest['artifacts'][ArtifactCache.artifact_key(make, with_model)] = {
+            'fingerprint': fingerprint, 'trained': entry is not None}
+
+    def write_manifest(self, dataset_fingerprint, max_miles=None):
+        # max_miles is the highest mileage of every make, which CachedQuoter needs for the out of range check
+        if self.read_only:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest['dataset'] = dataset_fingerprint
+        if max_miles is not None:
+            self.manifest['max_miles'] = max_miles
+        replace_file(os.path.join(self.directory, self.manifest_name), 'w',
+                     lambda manifest_file: json.dump(self.manifest, manifest_file, indent=1, sort_keys=True))
+
+
+class CachedQuoter:
+    # Quotes cars straight from the per make artifacts of the last training run, without loading the dataset. It
+    # needs neither pandas nor sklearn, so a headless quote only waits for numpy and one make's artifacts to load. The
+    # artifacts are not checked against the dataset, so quotes are as current as the last run that wrote the cache.
+    def __init__(self, directory):
+        self.cache = ArtifactCache(directory)
+        # Loaded entries keyed by (make, with_model), None for makes with insufficient data
+        self.entries = {}
+
+    def entry(self, make, with_model):
+        key = (make, with_model)
+        if key not in self.entries:
+            record = self.cache.manifest['artifacts'].get(ArtifactCache.artifact_key(make, with_model))
+            entry = None
+            if record is not None:
+                entry = self.cache.load(make, with_model, record['fingerprint'])[1]
+            self.entries[key] = entry
+        return self.entries[key]
+
+    def quote(self, year, make, model, mileage):
+        # Predict the price of a car with the rules of Model.quote, returning {'price', 'confidence'} or {'error'}
+        error = input_error(year, make, model, mileage)
+        if error is not None:
+            return {'error': error}
+        year = whole_number(year)
+        mileage = whole_number(mileage)
+        if ArtifactCache.artifact_key(make, True) not in self.cache.manifest['artifacts']:
+            return {'error': "no cached models for this make"}
+        listed = model != "Not listed"
+        entry = self.entry(make, listed)
+        if entry is not None and listed and not entry['encoder'].knows(model):
+            # Model names the make was not trained on are priced without model data
+            entry = self.entry(make, False)
+        if entry is None:
+            return {'error': INSUFFICIENT_ERROR}
+        price = int(entry['regressor'].predict(entry['encoder'].transform_one(year, model, mileage))[0])
+        confidence = entry['rating']
+        if price < 1000:
+            confidence = "weak"
+        max_miles = self.cache.manifest.get('max_miles', {}).get(make)
+        if max_miles is not None and mileage > max_miles:
+            confidence = "out of range"
+        return {'price': price, 'confidence': confidence}
@@ -0,0 +1,346 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import sklearn
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from artifacts import ArtifactCache
+from forest import TreeEnsemble
+from loader import load_car_data, load_car_data_legacy, load_snapshot, snapshot_path, write_snapshot
+from main import add_policy_arguments, policy_from_arguments
+from model import Model
+from quote_cache import QuoteCache
+from training import fit_gradient_boost
+
+
+def measure(function, repeat):
+    # Run a function repeat times and return the best and median wall time in seconds
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), statistics.median(timings)
+
+
+def scale_dataset(car_data, factor, mode='rows', seed=0):
+    # Build a synthetic dataset factor times the size of car_data. Every copy after the first has its mileage and
+    # price jittered so the models don't just see duplicates. In 'makes' mode every copy also becomes a new set of
+    # makes, so the number of makes grows with the rows instead of the rows per make.
+    if factor == 1:
+        return car_data
+    rng = np.random.default_rng(seed)
+    copies = []
+    for copy_number in range(factor):
+        copy = car_data.copy()
+        if copy_number:
+            copy['Miles'] = (copy['Miles'] * rng.uniform(0.95, 1.05, len(copy))).astype('int32')
+            copy['Price'] = (copy['Price'] * rng.uniform(0.97, 1.03, len(copy))).astype('int32')
+            if mode == 'makes':
+                copy['Make'] = copy['Make'].astype(str) + "-" + str(copy_number)
+        copy['Make'] = copy['Make'].astype(str)
+        copy['Model'] = copy['Model'].astype(object)
+        copies.append(copy)
+    scaled = pd.concat(copies, ignore_index=True)
+    scaled['Make'] = scaled['Make'].astype('category')
+    scaled['Model'] = scaled['Model'].astype('category')
+    return scaled
+
+
+# Run in a fresh interpreter to measure how much a loader raises the peak RSS of the process
+PEAK_RSS_SCRIPT = '''
+import json, sys
+import pandas as pd
+import loader
+
+def status(field):
+    with open('/proc/self/status') as status_file:
+        return int(next(line for line in status_file if line.startswith(field)).split()[1])
+
+# Reset the peak left by the imports, so the peak only covers the load
+with open('/proc/self/clear_refs', 'w') as clear_refs:
+    clear_refs.write('5')
+before = status('VmRSS')
+frame = getattr(loader, sys.argv[1])(sys.argv[2])
+# Read every value once, so memory mapped columns are counted too
+checksum = pd.util.hash_pandas_object(frame, index=False).sum()
+print(json.dumps({'before_kib': before, 'peak_kib': status('VmHWM')}))
+'''
+
+
+def peak_rss(loader_name, path):
+    # Peak RSS in KiB added by loading path with a loader function, measured in a child process. Relies on Linux's
+    # /proc/self/clear_refs to reset the peak, and reports None elsewhere.
+    if not os.path.exists('/proc/self/clear_refs'):
+        return None
+    output = subprocess.run([sys.executable, '-c', PEAK_RSS_SCRIPT, loader_name, path], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    result = json.loads(output)
+    return result['peak_kib'] - result['before_kib']
+
+
+def import_times(arguments, cwd):
+    # Run a fresh interpreter with python -X importtime and the given arguments, and return its wall time and the
+    # import time in seconds spent in each top level package, such as numpy or pandas, slowest first
+    start = time.perf_counter()
+    stderr = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, capture_output=True, text=True,
+                            check=True, cwd=cwd).stderr
+    seconds = time.perf_counter() - start
+    packages = {}
+    for line in stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        # Add up the self time of every module of the package, wherever it was imported from
+        package = fields[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(fields[0]) / 1e6
+    return seconds, sorted(packages.items(), key=lambda package: -package[1])
+
+
+def write_listings(car_data, path):
+    # Write a cleaned dataset back out in the carvana.csv format
+    names = car_data['Make'].astype(str) + " " + car_data['Model'].astype(object).fillna("").astype(str)
+    pd.DataFrame({'Name': " " + names.str.strip(), 'Year': car_data['Year'], 'Miles': car_data['Miles'],
+                  'Price': car_data['Price']}).to_csv(path, index=False)
+
+
+class Benchmark:
+    # Times the load, train, quote, batch, predict, chart and report paths of Model on datasets of increasing size,
+    # and the startup of fresh interpreters
+    paths = ('load', 'train', 'quote', 'batch', 'predict', 'graphs', 'report', 'startup')
+
+    def __init__(self, csv_path, repeat=5, quotes=200, workers=None, max_train_rows=250000, mode='rows',
+                 paths=None, policy=None):
+        self.csv_path = csv_path
+        self.repeat = repeat
+        self.quotes = quotes
+        self.workers = workers
+        self.max_train_rows = max_train_rows
+        self.mode = mode
+        self.selected = paths or Benchmark.paths
+        # Training policy of every model trained by the benchmark
+        self.policy = policy
+        self.results = []
+        # (scale, model) of the last fully trained model, shared by the train and report paths
+        self.trained = None
+
+    def record(self, scale, path, seconds, car_data, **extra):
+        result = {'scale': scale, 'path': path, 'rows': len(car_data),
+                  'makes': int(car_data['Make'].nunique()), 'seconds': seconds}
+        result.update(extra)
+        self.results.append(result)
+        print("  " + path + ": " + ("skipped" if seconds is None else format(seconds * 1000, '.3f') + " ms"),
+              file=sys.stderr)
+
+    def run(self, scales):
+        base = load_car_data(self.csv_path)
+        for scale in scales:
+            car_data = scale_dataset(base, scale, self.mode)
+            print("scale " + str(scale) + "x: " + str(len(car_data)) + " rows", file=sys.stderr)
+            for path in self.selected:
+                getattr(self, 'bench_' + path)(scale, car_data)
+        return self.results
+
+    def bench_load(self, scale, car_data):
+        # CSV -> cleaned frame, with the vectorized loader and the list comprehensions App.__init__ used to run, and
+        # the binary snapshot of the same frame, memory mapped and read into memory
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.abspath(self.csv_path)
+            if scale != 1:
+                path = os.path.join(directory, 'listings.csv')
+                write_listings(car_data, path)
+            snapshot = os.path.join(directory, os.path.basename(snapshot_path(path)))
+            write_snapshot(car_data, snapshot)
+            for name, loader, loader_name, source in (
+                    ('load', load_car_data, 'load_car_data', path),
+                    ('load_legacy', load_car_data_legacy, 'load_car_data_legacy', path),
+                    ('load_snapshot', load_snapshot, 'load_snapshot', snapshot),
+                    ('load_snapshot_read', lambda source: load_snapshot(source, mmap=False), None, snapshot)):
+                best, median = measure(lambda: loader(source), self.repeat)
+                extra = {}
+                if loader_name is not None:
+                    extra['peak_rss_kib'] = peak_rss(loader_name, source)
+                self.record(scale, name, best, car_data, median=median, **extra)
+
+    def bench_train(self, scale, car_data):
+        # Full training of every make, skipped above max_train_rows where it would take hours
+        if len(car_data) > self.max_train_rows:
+            self.record(scale, 'train', None, car_data, skipped="more than max_train_rows rows")
+            return
+        model = Model(car_data, workers=self.workers, policy=self.policy)
+        best, median = measure(model.generate_gradient_boost_model, 1)
+        self.trained = (scale, model)
+        self.record(scale, 'train', best, car_data, median=median, fit_seconds=model.fit_seconds,
+                    stages=sum(entry[3] for entry in model.report_with_model + model.report_without_model),
+                    r2=model.overall_accuracy)
+
+    def trained_model(self, scale, car_data):
+        # A model with every make trained, the one the train path timed when it ran at this scale, or None above
+        # max_train_rows
+        if len(car_data) > self.max_train_rows:
+            return None
+        if self.trained is None or self.trained[0] != scale:
+            model = Model(car_data, workers=self.workers, policy=self.policy)
+            model.generate_gradient_boost_model()
+            self.trained = (scale, model)
+        return self.trained[1]
+
+    def quoted_car(self, car_data):
+        # The most common model of the most common make
+        make = car_data['Make'].value_counts().index[0]
+        rows = car_data[car_data['Make'] == make]
+        return int(rows['Year'].median()), str(make), str(rows['Model'].value_counts().index[0]), \
+            int(rows['Miles'].median())
+
+    def quote_model(self, car_data):
+        # A lazy model with only the quoted make trained, so quotes can be timed at any scale
+        model = Model(car_data, workers=self.workers, lazy=True, policy=self.policy)
+        model.generate_gradient_boost_model()
+        year, make, name, miles = self.quoted_car(car_data)
+        model.quote(year, make, name, miles)
+        return model
+
+    def bench_quote(self, scale, car_data):
+        # Median single quote latency with model data and with "Not listed"
+        model = self.quote_model(car_data)
+        year, make, name, miles = self.quoted_car(car_data)
+        for path, quoted_name in (('quote_with_model', name), ('quote_not_listed', "Not listed")):
+            best, median = measure(lambda: model.quote(year, make, quoted_name, miles), self.quotes)
+            self.record(scale, path, best, car_data, median=median)
+        # Repeated quotes answered by the quote cache
+        model.quote_cache = QuoteCache()
+        model.quote(year, make, name, miles)
+        best, median = measure(lambda: model.quote(year, make, name, miles), self.quotes)
+        self.record(scale, 'quote_cached', best, car_data, median=median)
+
+    def bench_batch(self, scale, car_data):
+        # Batch pricing of every row of the quoted make
+        model = self.quote_model(car_data)
+        make = self.quoted_car(car_data)[1]
+        cars = car_data.loc[car_data['Make'] == make, ['Year', 'Make', 'Model', 'Miles']]
+        best, median = measure(lambda: model.calculate_listing_prices(cars), self.repeat)
+        self.record(scale, 'batch', best, car_data, median=median, cars=len(cars))
+
+    def bench_predict(self, scale, car_data):
+        # The quoted make's regressor against its exported TreeEnsemble, on one car and on 10000 cars drawn from the
+        # make's rows, recording whether the prices are identical
+        make = self.quoted_car(car_data)[1]
+        rows = car_data[car_data['Make'] == make]
+        regressor, _, encoder, _ = fit_gradient_boost(rows, True, {'random_state': 0}, self.policy)
+        trees = TreeEnsemble.from_gradient_boost(regressor)
+        features = encoder.transform(rows['Year'], rows['Miles'], rows['Model'])
+        batch = features[np.random.default_rng(0).integers(0, len(features), 10000)]
+        for size, cars, repeat in (('1', batch[:1], self.quotes), ('10k', batch, self.repeat)):
+            exact = bool(np.array_equal(regressor.predict(cars), trees.predict(cars)))
+            for name, predictor in (('sklearn', regressor), ('trees', trees)):
+                best, median = measure(lambda: predictor.predict(cars), repeat)
+                self.record(scale, 'predict_' + name + '_' + size, best, car_data, median=median, bit_exact=exact)
+
+    def bench_graphs(self, scale, car_data):
+        # Chart data and rendering of the three graphs, with the chart data rebuilt every time
+        model = Model(car_data)
+        for number, generate in (('one', model.generate_graph_one), ('two', model.generate_graph_two),
+                                 ('three', model.generate_graph_three)):
+            def render():
+                model.data_version += 1
+                FigureCanvasAgg(generate()).draw()
+            best, median = measure(render, self.repeat)
+            self.record(scale, 'graph_' + number, best, car_data, median=median)
+
+    def bench_startup(self, scale, car_data):
+        # Startup of a bare interpreter, of importing model and main, and of a headless quote from the model cache,
+        # each with its slowest top level imports. Startup does not depend on the dataset, so it only runs once.
+        if any(result['path'] == 'startup_interpreter' for result in self.results):
+            return
+        package = os.path.dirname(os.path.abspath(__file__))
+        year, make, name, miles = self.quoted_car(car_data)
+        with tempfile.TemporaryDirectory() as directory:
+            # A cache holding the quoted make's models
+            cache = os.path.join(directory, 'model_cache')
+            model = Model(car_data, cache=ArtifactCache(cache), workers=self.workers, lazy=True, policy=self.policy)
+            model.generate_gradient_boost_model()
+            model.quote(year, make, name, miles)
+            for path, arguments in (('startup_interpreter', ['-c', 'pass']),
+                                    ('startup_import_model', ['-c', 'import model']),
+                                    ('startup_import_main', ['-c', 'import main']),
+                                    ('startup_quote_cached', [os.path.join(package, 'main.py'), 'quote', str(year),
+                                                              make, name, str(miles), '--cache', cache])):
+                runs = sorted((import_times(arguments, package) for _ in range(self.repeat)), key=lambda run: run[0])
+                imports = [[imported, seconds] for imported, seconds in runs[0][1][:10]]
+                self.record(scale, path, runs[0][0], car_data, median=runs[len(runs) // 2][0], imports=imports)
+                for imported, seconds in imports[:5]:
+                    print("    " + imported + ": " + format(seconds * 1000, '.1f') + " ms", file=sys.stderr)
+
+    def bench_report(self, scale, car_data):
+        # The accuracy report of a fully trained model, since the makes a lazy model has not trained are reported as
+        # pending without looking at their scores
+        model = self.trained_model(scale, car_data)
+        if model is None:
+            self.record(scale, 'report', None, car_data, skipped="more than max_train_rows rows")
+            return
+        best, median = measure(model.generate_accuracy_report, self.repeat)
+        self.record(scale, 'report', best, car_data, median=median, trained_makes=len(model.trained_makes()))
+
+
+def compare(results, baseline, threshold):
+    # Print the change of every (scale, path) against a saved baseline and return the regressions
+    saved = {(result['scale'], result['path']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = saved.get((result['scale'], result['path']))
+        if before is None or before['seconds'] is None or result['seconds'] is None:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(result)
+        print(format(str(result['scale']) + "x " + result['path'], '<28') + format(before['seconds'] * 1000, '12.3f')
+              + " ms -> " + format(result['seconds'] * 1000, '12.3f') + " ms  " + format(ratio, '6.2f') + "x" + flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the car price predictor without a display')
+    parser.add_argument('--data', default='carvana.csv', help='dataset the synthetic datasets are scaled from')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='dataset size multipliers')
+    parser.add_argument('--mode', choices=['rows', 'makes'], default='rows',
+                        help='grow the rows of each make, or add new makes')
+    parser.add_argument('--paths', nargs='+', choices=Benchmark.paths, help='only run these paths')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per timing')
+    parser.add_argument('--quotes', type=int, default=200, help='single quotes per quote timing')
+    parser.add_argument('--workers', type=int, help='training processes')
+    parser.add_argument('--max-train-rows', type=int, default=250000, help='skip full training above this size')
+    add_policy_arguments(parser)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='baseline JSON file to compare the results against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.data, args.repeat, args.quotes, args.workers, args.max_train_rows, args.mode,
+                          args.paths, policy_from_arguments(args))
+    results = benchmark.run(args.scales)
+    report = {'meta': {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'pandas': pd.__version__, 'sklearn': sklearn.__version__, 'machine': platform.machine(),
+                       'cpus': os.cpu_count(), 'mode': args.mode, 'policy': policy_from_arguments(args)},
+              'results': results}
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=1)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
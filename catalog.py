@@ -0,0 +1,52 @@
+from bisect import bisect_left
+
+
+class PrefixIndex:
+    # Names sorted case insensitively, so the names starting with a prefix are found with a binary search instead of
+    # a scan of every name
+    def __init__(self, names):
+        pairs = sorted((name.casefold(), name) for name in names)
+        self.keys = [key for key, _ in pairs]
+        self.names = [name for _, name in pairs]
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, prefix, limit=None):
+        # Names starting with prefix, ignoring case, in sorted order
+        prefix = prefix.casefold()
+        start = bisect_left(self.keys, prefix)
+        end = start
+        stop = len(self.keys) if limit is None else min(len(self.keys), start + limit)
+        while end < stop and self.keys[end].startswith(prefix):
+            end += 1
+        return self.names[start:end]
+
+
+class ModelCatalog:
+    # Every make and the sorted model names of each make, built once from a Model so selecting a make or typing in a
+    # combobox never goes back to the listings. The catalog remembers the data version it was built from, so callers
+    # can rebuild it after new listings arrive.
+    def __init__(self, models, version=None):
+        self.makes = PrefixIndex(models)
+        self.models = {make: PrefixIndex(names) for make, names in models.items()}
+        self.version = version
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.models_by_make(), model.data_version)
+
+    def all_makes(self):
+        return list(self.makes.names)
+
+    def all_models(self, make):
+        # Models of a make, or none for a make that is not in the listings
+        return list(self.models[make].names) if make in self.models else []
+
+    def search_makes(self, prefix, limit=None):
+        return self.makes.search(prefix, limit)
+
+    def search_models(self, make, prefix, limit=None):
+        if make not in self.models:
+            return []
+        return self.models[make].search(prefix, limit)
@@ -1,63 +1,118 @@
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from catalog import ModelCatalog
+
+# Model choice for cars whose model is not in the listings
+NOT_LISTED = "Not listed"
 
 
 class Controller:
-    def __init__(self, model, view):
+    def __init__(self, model, view, history=None):
         self.model = model
         self.view = view
+        # Canvas of each graph and the data version it was drawn from
+        self.canvases = {}
+        # Makes and models for the comboboxes, rebuilt when the listings change
+        self.model_catalog = None
+        # QuoteHistory every price calculated is written to, or None to keep no history
+        self.history = history
+
+    def catalog(self):
+        if self.model_catalog is None or self.model_catalog.version != self.model.data_version:
+            self.model_catalog = ModelCatalog.from_model(self.model)
+        return self.model_catalog
+
+    def load_makes(self):
+        self.view.populate_combobox(self.catalog().all_makes(), self.view.make_menu)
 
     def load_models(self, make):
-        models = []
-        for model in self.model.get_all_models(make):
-            if str(model) != "nan":
-                models.append(str(model))
-        models.append("Not listed")
-        self.view.populate_combobox(models, self.view.model_menu)
+        self.view.populate_combobox(self.catalog().all_models(make) + [NOT_LISTED], self.view.model_menu)
+
+    def search_makes(self, prefix):
+        return self.catalog().search_makes(prefix)
+
+    def search_models(self, make, prefix):
+        models = self.catalog().search_models(make, prefix)
+        if NOT_LISTED.casefold().startswith(prefix.casefold()):
+            models.append(NOT_LISTED)
+        return models
+
+    def load_history(self):
+        # Show the end of the quote history, reading only the rows on screen
+        if self.history is not None:
+            self.view.table.set_source(len(self.history), self.history.rows)
+
+    def record_quote(self, year, make, model, mileage, price):
+        # Append a quote to the history and return the number of quotes in it
+        if self.history is None:
+            return 0
+        return self.history.append(year, make, model, mileage, price)
 
     def generate_price(self, year, make, model, mileage):
         predicted_price = self.model.calculate_listing_price(year, make, model, mileage)
         return predicted_price
 
-    def load_graph_one(self):
-        plt.rcParams["figure.figsize"] = [10, 5]
-        plt.rcParams["figure.autolayout"] = True
-        canvas = FigureCanvasTkAgg(self.model.generate_graph_one(), master=self.view)
-        canvas.draw()
+    def load_graph(self, name, generate):
+        # Each graph keeps one figure and canvas, which are only redrawn when the data has changed since the last draw
+        canvas, version = self.canvases.get(name, (None, None))
+        if canvas is None:
+            # matplotlib and its Tk backend are imported with the first graph rather than with the controller
+            import matplotlib
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            from matplotlib.figure import Figure
+            matplotlib.rcParams["figure.figsize"] = [10, 5]
+            matplotlib.rcParams["figure.autolayout"] = True
+            canvas = FigureCanvasTkAgg(Figure(), master=self.view)
+        if version != self.model.data_version:
+            generate(canvas.figure)
+            canvas.draw()
+            self.canvases[name] = (canvas, self.model.data_version)
         return canvas
 
+    def load_graph_one(self):
+        return self.load_graph('one', self.model.generate_graph_one)
+
     def load_graph_two(self):
-        plt.rcParams["figure.figsize"] = [10, 5]
-        plt.rcParams["figure.autolayout"] = True
-        canvas = FigureCanvasTkAgg(self.model.generate_graph_two(), master=self.view)
-        canvas.draw()
-        return canvas
+        return self.load_graph('two', self.model.generate_graph_two)
 
     def load_graph_three(self):
-        plt.rcParams["figure.figsize"] = [10, 5]
-        plt.rcParams["figure.autolayout"] = True
-        canvas = FigureCanvasTkAgg(self.model.generate_graph_three(), master=self.view)
-        canvas.draw()
-        return canvas
+        return self.load_graph('three', self.model.generate_graph_three)
 
     def load_accuracy(self):
         entries = self.model.generate_accuracy_report()
+        averages = entries[0]
         # Add the overall averages and column names to the beginning of the report
-        report = ["Overall average R2 score: " + str(entries[0]),
-                  "Average R2 score when model is included in calculation: " + str(entries[1]),
-                  "Average R2 score when model is not included in calculation: " + str(entries[2]),
+        report = ["Overall average R2 score: " + str(averages[0]),
+                  "Average R2 score when model is included in calculation: " + str(averages[1]),
+                  "Average R2 score when model is not included in calculation: " + str(averages[2]),
+                  "Total fit time in seconds: " + str(averages[3]),
+                  "Makes trained: " + str(len(self.model.trained_makes())) + " of " +
+                  str(len(self.model.get_all_makes())) + ", pending: " +
+                  (", ".join(self.model.pending_makes()) or "none"),
                   "Index, Make, R2 Rating with model data, R2 Rating without model data, "
-                  "R2 score with model data, R2 score without model data"
+                  "R2 score with model data, R2 score without model data, "
+                  "Stages with model data, Stages without model data, "
+                  "Fit seconds with model data, Fit seconds without model data"
                   ]
         # Add the data for each manufacturer to the report
         line_number = 1
         for entry in entries[1:]:
             maker = entry[0]
-            rw = entry[1]
-            rwo = entry[2]
+            rw = str(entry[1])
+            rwo = str(entry[2])
             r2w = str(entry[3])
             r2wo = str(entry[4])
-            new_line = (str(line_number) + ": " + maker + ", " + rw + ", " + rwo + ", " + r2w + ", " + r2wo)
+            stages = str(entry[5]) + ", " + str(entry[6])
+            seconds = ", ".join("None" if value is None else format(value, '.3f') for value in entry[7:9])
+            new_line = (str(line_number) + ": " + maker + ", " + rw + ", " + rwo + ", " + r2w + ", " + r2wo + ", " +
+                        stages + ", " + seconds)
             report.append(new_line)
             line_number += 1
         return report
+
+    def load_metrics(self):
+        report = self.model.metrics.report()
+        if self.model.quote_cache is not None:
+            stats = self.model.quote_cache.stats()
+            report.append("Quote cache: " + str(stats['entries']) + " of " + str(stats['max_entries']) + " quotes, " +
+                          str(stats['hits']) + " hits, " + str(stats['misses']) + " misses, hit rate " +
+                          ("-" if stats['hit_rate'] is None else format(stats['hit_rate'], '.1%')))
+        return report
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class FeatureEncoder:
+    # Turns cars into the feature matrix of one make's regressor without building a frame: Year, Miles and, with
+    # model data, an indicator column for every model name of the make except the first, the same layout
+    # pd.get_dummies(drop_first=True) produced. Only the model name -> column mapping is kept, so the encoder is small
+    # enough to be pickled with the fitted regressor. Encoding one car only needs numpy, so pandas and scipy are
+    # imported by the methods that use them.
+    def __init__(self, models=None):
+        # models is the sorted list of model names seen in training, or None for a regressor without model data
+        self.with_model = models is not None
+        self.models = list(models or [])
+        # The first model is the baseline every indicator is relative to, so it has no column of its own
+        self.model_columns = {name: 2 + position for position, name in enumerate(self.models[1:])}
+        self.columns = ['Year', 'Miles'] + ['Model_' + name for name in self.models[1:]]
+
+    @classmethod
+    def fit(cls, rows, with_model):
+        # Collect the model names of one make's rows. Missing models are left out, like get_dummies did.
+        if not with_model:
+            return cls()
+        import pandas as pd
+        return cls(sorted(str(name) for name in pd.unique(rows['Model'].dropna())))
+
+    def knows(self, models):
+        # Whether the model names were seen in training, for one name or an array of names
+        if isinstance(models, str):
+            return models in self.model_columns or models in self.models[:1]
+        import pandas as pd
+        codes, names = pd.factorize(np.asarray(models, dtype=object))
+        known = np.array([name in self.model_columns or name in self.models[:1] for name in names], dtype=bool)
+        return (codes >= 0) & known[codes] if len(names) else np.zeros(len(codes), dtype=bool)
+
+    def model_positions(self, models):
+        # Column of each model's indicator, or -1 for the baseline model, missing models and names that were not seen
+        # in training. Each distinct name is looked up once.
+        import pandas as pd
+        codes, names = pd.factorize(np.asarray(models, dtype=object))
+        if not len(names):
+            return np.full(len(codes), -1, dtype=np.intp)
+        lookup = np.array([self.model_columns.get(name, -1) for name in names], dtype=np.intp)
+        return np.where(codes >= 0, lookup[codes], -1)
+
+    def transform(self, years, miles, models=None, sparse=False):
+        # Encode a batch of cars as a float32 matrix, or as a CSR matrix if sparse is set. Unseen models get no
+        # indicator, so callers that care about them should check knows() first.
+        years = np.asarray(years, dtype=np.float32)
+        miles = np.asarray(miles, dtype=np.float32)
+        count = len(years)
+        rows = np.arange(count)
+        if self.with_model and models is not None:
+            positions = self.model_positions(models)
+        else:
+            positions = np.full(count, -1, dtype=np.intp)
+        indicated = positions >= 0
+        if sparse:
+            from scipy import sparse as scipy_sparse
+            indicator_rows = rows[indicated]
+            data = np.concatenate([years, miles, np.ones(len(indicator_rows), dtype=np.float32)])
+            row_index = np.concatenate([rows, rows, indicator_rows])
+            column_index = np.concatenate([np.zeros(count, dtype=np.intp), np.ones(count, dtype=np.intp),
+                                           positions[indicated]])
+            return scipy_sparse.csr_matrix((data, (row_index, column_index)), shape=(count, len(self.columns)),
+                                           dtype=np.float32)
+        features = np.zeros((count, len(self.columns)), dtype=np.float32)
+        features[:, 0] = years
+        features[:, 1] = miles
+        features[rows[indicated], positions[indicated]] = 1
+        return features
+
+    def transform_one(self, year, model, miles):
+        # Encode a single car into one small array
+        features = np.zeros((1, len(self.columns)), dtype=np.float32)
+        features[0, 0] = year
+        features[0, 1] = miles
+        if self.with_model and model in self.model_columns:
+            features[0, self.model_columns[model]] = 1
+        return features
@@ -0,0 +1,115 @@
+import pickle
+
+import numpy as np
+
+
+class TreeEnsemble:
+    # A fitted GradientBoostingRegressor flattened into numpy arrays, so cars can be priced without sklearn or its
+    # input validation, which costs far more than the trees themselves on a single quote. The nodes of every tree are
+    # stored one after another in the same arrays and leaves are their own children, so a batch walks all trees
+    # together, one level per step. The prediction adds the init value and then each stage's leaf value in stage
+    # order, the same float64 operations in the same order as sklearn, so prices are identical to the regressor's.
+    # Cars predicted at a time, which keeps the (splits, cars) and (trees, cars) arrays of a batch in cache
+    batch_rows = 256
+
+    def __init__(self, split_features, split_thresholds, splits, children, values, roots, init, depth, n_features):
+        # Feature and threshold of every split node, a car goes left when feature <= threshold like in sklearn
+        self.split_features = split_features
+        self.split_thresholds = split_thresholds
+        # Position of every node among the split nodes, 0 for leaves
+        self.splits = splits
+        # Left and right child of node i at 2 * i and 2 * i + 1, a leaf is its own child
+        self.children = children
+        # Leaf values already multiplied by the learning rate
+        self.values = values
+        # Root node of every tree, in stage order
+        self.roots = roots
+        # Prediction before the first stage
+        self.init = init
+        # Depth of the deepest leaf, the number of steps that takes every car to a leaf of every tree
+        self.depth = depth
+        self.n_features = n_features
+
+    @classmethod
+    def from_gradient_boost(cls, regressor):
+        # Export a fitted GradientBoostingRegressor. Only the default init estimator, which predicts the mean price,
+        # and init='zero' start every car from the same value, which is all the export stores.
+        if isinstance(regressor.init_, str):
+            init = 0.0
+        elif hasattr(regressor.init_, 'constant_'):
+            init = float(np.asarray(regressor.init_.constant_, dtype=np.float64).ravel()[0])
+        else:
+            raise ValueError("only regressors with the default or the zero init estimator can be exported")
+        trees = [estimator.tree_ for estimator in regressor.estimators_[:, 0]]
+        roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]]).astype(np.intp)
+        features = []
+        thresholds = []
+        left = []
+        right = []
+        values = []
+        for root, tree in zip(roots, trees):
+            nodes = np.arange(tree.node_count, dtype=np.intp)
+            leaves = tree.children_left < 0
+            features.append(tree.feature)
+            thresholds.append(tree.threshold.astype(np.float64))
+            left.append(root + np.where(leaves, nodes, tree.children_left))
+            right.append(root + np.where(leaves, nodes, tree.children_right))
+            # sklearn adds learning_rate * value to the running prediction, this is the same product
+            values.append(regressor.learning_rate * tree.value[:, 0, 0].astype(np.float64))
+        left = np.concatenate(left)
+        right = np.concatenate(right)
+        split_nodes = np.flatnonzero(left != np.arange(len(left)))
+        splits = np.zeros(len(left), dtype=np.intp)
+        splits[split_nodes] = np.arange(len(split_nodes))
+        children = np.empty(2 * len(left), dtype=np.intp)
+        children[0::2] = left
+        children[1::2] = right
+        return cls(np.concatenate(features)[split_nodes].astype(np.intp), np.concatenate(thresholds)[split_nodes],
+                   splits, children, np.concatenate(values), roots, init, max(tree.max_depth for tree in trees),
+                   int(regressor.n_features_in_))
+
+    def predict(self, x):
+        # Predict the prices of a feature matrix, or of one car's feature vector. Features are rounded to float32
+        # first, as sklearn does.
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        if x.shape[1] != self.n_features:
+            raise ValueError("expected " + str(self.n_features) + " features, got " + str(x.shape[1]))
+        columns = x.T
+        predictions = np.empty(len(x), dtype=np.float64)
+        for start in range(0, len(x), TreeEnsemble.batch_rows):
+            chunk = np.ascontiguousarray(columns[:, start:start + TreeEnsemble.batch_rows])
+            count = chunk.shape[1]
+            # Whether each car goes right at each split, one row per split. Comparing the float32 features with the
+            # float64 thresholds matches sklearn, and a missing value goes right as it does there.
+            right = ~(chunk[self.split_features] <= self.split_thresholds[:, None])
+            right = right.ravel()
+            cars = np.arange(count)
+            nodes = np.repeat(self.roots[:, None], count, axis=1)
+            for _ in range(self.depth):
+                nodes = self.children[2 * nodes + right[self.splits[nodes] * count + cars]]
+            totals = np.empty((len(self.roots) + 1, count), dtype=np.float64)
+            totals[0] = self.init
+            totals[1:] = self.values[nodes]
+            # A running sum adds the stages one at a time, in the order and with the rounding of sklearn
+            predictions[start:start + count] = np.cumsum(totals, axis=0)[-1]
+        return predictions
+
+
+class PickledRegressor:
+    # A regressor kept as pickled bytes and only unpickled, importing its library, the first time it predicts. Entries
+    # keep the fitted sklearn regressor this way next to its TreeEnsemble, which walks every car through the trees in
+    # numpy and loses to sklearn's compiled loop on large batches, so loading an entry still doesn't import sklearn.
+    def __init__(self, regressor):
+        self.data = pickle.dumps(regressor, protocol=pickle.HIGHEST_PROTOCOL)
+        self.regressor = None
+
+    def __getstate__(self):
+        # Only the bytes are saved, never the unpickled regressor
+        return {'data': self.data, 'regressor': None}
+
+    def predict(self, x):
+        if self.regressor is None:
+            self.regressor = pickle.loads(self.data)
+        return self.regressor.predict(x)
@@ -0,0 +1,133 @@
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from metrics import METRICS
+from training import rate_score
+
+# Histogram boosting accepts at most this many categories in a categorical feature, or max_bins if that is lower
+MAX_CATEGORIES = 255
+
+
+def model_codes(car_data):
+    # Number the models of each make from 0. Histogram boosting only accepts up to 255 categories per feature, fewer
+    # than the number of models in the dataset, but few makes have anywhere near that many models, so the model is
+    # encoded by its position within the make and the trees tell the makes apart through the Make feature. Make and
+    # Model only become categorical features while they fit in the limit, above it they are plain numeric codes that
+    # the trees split by threshold.
+    codes = {}
+    for make, models in car_data.groupby('Make', observed=True, sort=False)['Model']:
+        codes[str(make)] = {str(name): code for code, name in enumerate(sorted(models.dropna().unique()))}
+    return codes
+
+
+def global_features(entry, makes, cars):
+    # Build the feature frame of the shared model for cars with Year, Model and Miles columns
+    # makes is either one make for every car or a make per car
+    if isinstance(makes, str):
+        makes = [makes] * len(cars)
+    else:
+        makes = [str(make) for make in makes]
+    features = pd.DataFrame({'Year': np.asarray(cars['Year'], dtype=float),
+                             'Miles': np.asarray(cars['Miles'], dtype=float)})
+    # Unknown makes and models become missing values, which the trees route like any other missing value
+    make_feature = pd.Categorical(makes, categories=entry['makes'])
+    if not entry.get('categorical_makes', True):
+        make_feature = np.where(make_feature.codes >= 0, make_feature.codes, np.nan)
+    features['Make'] = make_feature
+    if entry['with_model']:
+        codes = [entry['model_codes'].get(make, {}).get(model) for make, model in zip(makes, cars['Model'])]
+        if entry.get('categorical_models', True):
+            features['Model'] = pd.Categorical(codes, categories=range(entry['n_codes']))
+        else:
+            features['Model'] = np.array([np.nan if code is None else code for code in codes], dtype=float)
+    return features
+
+
+def train_global(car_data, params, policy=None):
+    # Train one histogram gradient boosting model with and one without model data over every make. Each make is
+    # scored on its own rows of the shared hold-out split, and gets a registry entry pointing at the shared model,
+    # or None when it has too few hold-out rows for an r2 score.
+    # Histogram boosting has its own early stopping, which a training policy turns on or off. Time budgets only apply
+    # to the per make engine, since fitting the shared models is a single fit call.
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from sklearn.metrics import r2_score
+    from sklearn.model_selection import train_test_split
+    if policy is not None:
+        params = dict(params, early_stopping=policy['early_stopping'],
+                      validation_fraction=policy['validation_fraction'], n_iter_no_change=policy['n_iter_no_change'])
+    codes = model_codes(car_data)
+    makes = sorted(codes)
+    n_codes = max(1, max(len(make_codes) for make_codes in codes.values()))
+    limit = min(MAX_CATEGORIES, params.get('max_bins', MAX_CATEGORIES))
+    train_rows, test_rows = train_test_split(car_data, test_size=0.2, random_state=42)
+    entries = {}
+    for model in (True, False):
+        template = {'engine': 'global', 'with_model': model, 'makes': makes, 'model_codes': codes, 'n_codes': n_codes,
+                    'categorical_makes': len(makes) <= limit, 'categorical_models': n_codes <= limit}
+        x_train = global_features(template, train_rows['Make'], train_rows)
+        regressor = HistGradientBoostingRegressor(categorical_features='from_dtype', **params)
+        start = time.perf_counter()
+        with METRICS.stage('fit', len(x_train)):
+            regressor.fit(x_train, train_rows['Price'])
+        fit_seconds = time.perf_counter() - start
+        # Predict the whole hold-out split at once and score it make by make
+        with METRICS.stage('evaluate', len(test_rows)):
+            predicted = pd.Series(regressor.predict(global_features(template, test_rows['Make'], test_rows)),
+                                  index=test_rows.index)
+        test_groups = test_rows.groupby('Make', observed=True, sort=False)['Price']
+        for make in codes:
+            entries[(make, model)] = None
+            if make not in test_groups.groups:
+                continue
+            actual = test_groups.get_group(make)
+            with warnings.catch_warnings():
+                warnings.filterwarnings('error')
+                try:
+                    score = r2_score(actual, predicted[actual.index])
+                except Warning:
+                    # Makes with insufficient entries for an accurate score get no prediction model
+                    continue
+            entries[(make, model)] = dict(template, regressor=regressor, columns=list(x_train.columns), r2=score,
+                                          rating=rate_score(score), stages=int(regressor.n_iter_),
+                                          fit_seconds=fit_seconds)
+    return entries
+
+
+def compare_engines(car_data, quotes=200):
+    # Compare training time, single quote latency and per make r2 of the per make and global engines
+    from model import Model
+    samples = car_data.sample(quotes, random_state=0)
+    results = {}
+    for engine in ('per_make', 'global'):
+        model = Model(car_data, engine=engine, workers=1)
+        start = time.perf_counter()
+        model.generate_gradient_boost_model()
+        train_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for car in samples.itertuples():
+            name = car.Model if isinstance(car.Model, str) else "Not listed"
+            model.quote(car.Year, car.Make, name, car.Miles)
+        quote_seconds = (time.perf_counter() - start) / quotes
+        results[engine] = {'train_seconds': train_seconds, 'quote_seconds': quote_seconds,
+                           'overall_r2': model.overall_accuracy, 'r2_with_model': model.accuracy_with_model,
+                           'r2_without_model': model.accuracy_without_model,
+                           'makes': {entry[0]: entry[1] for entry in model.report_with_model}}
+    return results
+
+
+if __name__ == '__main__':
+    from loader import load_car_data
+    comparison = compare_engines(load_car_data(sys.argv[1] if len(sys.argv) > 1 else 'carvana.csv'))
+    for engine_name, result in comparison.items():
+        print(engine_name + ": train " + format(result['train_seconds'], '.2f') + " s, quote "
+              + format(result['quote_seconds'] * 1000, '.2f') + " ms, r2 overall "
+              + format(result['overall_r2'], '.3f') + ", with model " + format(result['r2_with_model'], '.3f')
+              + ", without model " + format(result['r2_without_model'], '.3f'))
+    print("R2 with model data by make (per_make / global):")
+    for make_name in sorted(comparison['per_make']['makes'].keys() | comparison['global']['makes'].keys()):
+        scores = [comparison[engine_name]['makes'].get(make_name) for engine_name in ('per_make', 'global')]
+        print("  " + make_name + ": " + " / ".join("-" if score is None else format(score, '.3f') for score in scores))
@@ -0,0 +1,50 @@
+import csv
+import io
+import os
+
+HISTORY_COLUMNS = ['Year', 'Make', 'Model', 'Mileage', 'Price']
+
+
+class QuoteHistory:
+    # Quotes appended to a CSV file as they are made, so the history survives restarts. Only the byte offset of each
+    # row is kept in memory and rows are read back from the file by position, so a table can show any window of a
+    # history of any length without loading all of it.
+    def __init__(self, path='quote_history.csv'):
+        self.path = path
+        self.offsets = []
+        if not os.path.isfile(path):
+            with open(path, 'w', newline='', encoding='utf-8') as history_file:
+                csv.writer(history_file).writerow(HISTORY_COLUMNS)
+        with open(path, 'rb') as history_file:
+            # Skip the header
+            offset = len(history_file.readline())
+            line = b'\n'
+            for line in history_file:
+                if line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+        if not line.endswith(b'\n'):
+            # The last row was cut short by a crash, end it so the next quote starts on a line of its own
+            with open(path, 'ab') as history_file:
+                history_file.write(b'\r\n')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, year, make, model, mileage, price):
+        # Write one quote to the end of the file and return its entry number, counted from 1
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([year, make, model, mileage, price])
+        with open(self.path, 'ab') as history_file:
+            self.offsets.append(history_file.tell())
+            history_file.write(buffer.getvalue().encode('utf-8'))
+        return len(self.offsets)
+
+    def rows(self, start, stop):
+        # Quotes start to stop - 1, each a list in the order of HISTORY_COLUMNS
+        lines = []
+        with open(self.path, 'rb') as history_file:
+            for offset in self.offsets[max(start, 0):max(stop, 0)]:
+                history_file.seek(offset)
+                lines.append(history_file.readline().decode('utf-8'))
+        return list(csv.reader(lines))
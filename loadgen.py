@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from loader import load_dataset
+
+
+def sample_cars(path, count, seed=0):
+    # Pick cars from the dataset to quote, a quarter of them without a model
+    cars = load_dataset(path).sample(count, replace=True, random_state=seed)
+    rng = random.Random(seed)
+    samples = []
+    for car in cars.itertuples():
+        model = car.Model if isinstance(car.Model, str) and rng.random() >= 0.25 else "Not listed"
+        samples.append({'year': int(car.Year), 'make': car.Make, 'model': model, 'miles': int(car.Miles)})
+    return samples
+
+
+async def client(host, port, requests, latencies, errors, rejected):
+    # One keep-alive connection sending requests one after another
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for path, payload in requests:
+            body = json.dumps(payload).encode()
+            start = time.perf_counter()
+            writer.write(('POST ' + path + ' HTTP/1.1\r\nHost: ' + host + '\r\nContent-Type: application/json\r\n'
+                          'Content-Length: ' + str(len(body)) + '\r\n\r\n').encode() + body)
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            response = json.loads(await reader.readexactly(length))
+            latencies.append(time.perf_counter() - start)
+            if not status.startswith(b'HTTP/1.1 200'):
+                errors.append(response)
+            elif 'error' in response:
+                # Cars the service can't price, such as makes with insufficient data
+                rejected.append(response)
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run(host, port, cars, concurrency, batch_size):
+    # Spread the requests over the clients and report latency percentiles and throughput
+    if batch_size > 1:
+        requests = [('/quotes', {'cars': cars[i:i + batch_size]}) for i in range(0, len(cars), batch_size)]
+    else:
+        requests = [('/quote', car) for car in cars]
+    latencies = []
+    errors = []
+    rejected = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, requests[i::concurrency], latencies, errors, rejected)
+                           for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {'requests': len(latencies), 'cars': len(cars), 'errors': len(errors), 'rejected': len(rejected),
+            'seconds': elapsed, 'requests_per_second': len(latencies) / elapsed,
+            'cars_per_second': len(cars) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator for the car price quote service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data', default='carvana.csv', help='dataset to sample the quoted cars from')
+    parser.add_argument('--requests', type=int, default=2000, help='number of cars to quote')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of parallel connections')
+    parser.add_argument('--batch-size', type=int, default=1, help='cars per request, above 1 uses /quotes')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    cars = sample_cars(args.data, args.requests)
+    results = asyncio.run(run(args.host, args.port, cars, args.concurrency, args.batch_size))
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    print(str(results['requests']) + " requests (" + str(results['cars']) + " cars) in "
+          + format(results['seconds'], '.2f') + " s, " + str(results['errors']) + " errors, "
+          + str(results['rejected']) + " quotes rejected")
+    print("throughput: " + format(results['requests_per_second'], '.1f') + " requests/s, "
+          + format(results['cars_per_second'], '.1f') + " cars/s")
+    print("latency: p50 " + format(results['p50_ms'], '.2f') + " ms, p99 " + format(results['p99_ms'], '.2f') + " ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,111 @@
+import argparse
 
-import tkinter as tk
-import pandas as pd
-
-
-from controller import Controller
-from model import Model
-from view import View
-
-
-class App(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title('Car sale price generator')
-        # create a model
-        df_original = pd.read_csv('carvana.csv')
-        column_names = ["Year", "Make", "Model", "Miles", "Price"]
-        df_modified = pd.DataFrame(columns=column_names)
-        # Populate the columns
-        df_modified['Year'] = [int(x[:4]) for x in df_original['Year'].astype(str)]
-        df_modified['Make'] = [x.split()[0] for x in df_original['Name']]
-        df_modified['Model'] = df_original['Name'].str.split(n=1).str[1]
-        df_modified['Miles'] = df_original['Miles']
-        df_modified['Price'] = df_original['Price']
-        model = Model(df_modified)
-
-        # Generate predictive model for each make with and without model information
-        model.generate_gradient_boost_model()
-        # create a view and place it on the root window
-        view = View(self)
-        self.geometry("1050x1050")
-        view.grid(row=0, column=0, padx=30, pady=20)
-        # create a controller
-        controller = Controller(model, view)
-        # set the controller to view
-        view.set_controller(controller)
-        # populate combo boxes with data from csv
-        # year
-        view.populate_combobox(model.get_years(), view.year_menu)
-        # make
-        view.populate_combobox(model.get_all_makes(), view.make_menu)
-        # Show a graph
-        view.graph_one_button_clicked()
+from metrics import METRICS, profile_call
+
+# Everything else is imported by the command that needs it, so headless commands never load the GUI, matplotlib or
+# sklearn, and quoting from the model cache doesn't load pandas either
+
+
+def build_model(path='carvana.csv', lazy=False, policy=None, quote_cache=None, read_only_cache=False):
+    # Load the dataset, from its binary snapshot when there is an up to date one or from its partitions when path is a
+    # partitioned directory, and generate predictive models for each make with and without model information, reusing
+    # the models saved in model_cache for makes whose data has not changed. In lazy mode the models are only trained or
+    # reloaded when a make is first quoted. With read_only_cache models are reloaded from model_cache but nothing is
+    # saved to it.
+    from artifacts import ArtifactCache
+    from model import Model
+    from partitions import load_listings
+    model = Model(load_listings(path), cache=ArtifactCache('model_cache', read_only_cache), lazy=lazy, policy=policy,
+                  quote_cache=quote_cache)
+    model.generate_gradient_boost_model()
+    return model
+
+
+def quote_batch(input_path, output_path, data_path='carvana.csv', lazy=False, profile=None, profile_path=None,
+                policy=None):
+    # Price every car in a CSV of Year, Make, Model and Miles without opening a window
+    # profile is 'train' or 'quote' to run that phase under cProfile and print its profile
+    if profile == 'train':
+        model, profile_text = profile_call(build_model, data_path, lazy, policy, path=profile_path)
+        print(profile_text)
+    else:
+        model = build_model(data_path, lazy, policy)
+    import pandas as pd
+    cars = pd.read_csv(input_path)
+    if profile == 'quote':
+        quotes, profile_text = profile_call(model.calculate_listing_prices, cars, path=profile_path)
+        print(profile_text)
+    else:
+        quotes = model.calculate_listing_prices(cars)
+    quotes.to_csv(output_path, index=False)
+    return quotes
+
+
+def write_metrics(path):
+    # Save the recorded metrics as JSON, or as Prometheus text unless the file name ends in .json
+    with open(path, 'w') as metrics_file:
+        metrics_file.write(METRICS.to_json() if path.endswith('.json') else METRICS.to_prometheus())
+
+
+def add_policy_arguments(parser):
+    parser.add_argument('--early-stopping', action='store_true',
+                        help='stop adding boosting stages once the validation loss stops improving')
+    parser.add_argument('--make-budget', type=float, help='seconds of fitting allowed for each model')
+    parser.add_argument('--total-budget', type=float, help='seconds of fitting allowed for the whole training run')
+
+
+def policy_from_arguments(args):
+    # The training policy asked for on the command line, or None to fit every stage
+    if not args.early_stopping and args.make_budget is None and args.total_budget is None:
+        return None
+    from training import training_policy
+    return training_policy(early_stopping=args.early_stopping, make_seconds=args.make_budget,
+                           total_seconds=args.total_budget)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Car sale price generator')
+    parser.add_argument('--metrics', action='store_true', help='record stage timings and cache counters')
+    parser.add_argument('--history', default='quote_history.csv', help='file the window keeps its quotes in')
+    subparsers = parser.add_subparsers(dest='command')
+    batch = subparsers.add_parser('batch', help='price a CSV of Year, Make, Model and Miles and write the quotes')
+    batch.add_argument('input', help='CSV file with Year, Make, Model and Miles columns')
+    batch.add_argument('output', help='CSV file to write with Predicted Price and Confidence columns added')
+    batch.add_argument('--data', default='carvana.csv',
+                       help='dataset used to train the models, a CSV or a partitioned directory')
+    batch.add_argument('--lazy', action='store_true', help='only train the makes that appear in the input')
+    batch.add_argument('--metrics-output', help='file to write the metrics to, as JSON if it ends in .json and '
+                                                'as Prometheus text otherwise; turns on --metrics')
+    batch.add_argument('--profile', choices=['train', 'quote'], help='run training or pricing under cProfile')
+    batch.add_argument('--profile-output', help='file to save the raw cProfile stats to')
+    add_policy_arguments(batch)
+    quote = subparsers.add_parser('quote', help='price one car with the models saved in the model cache, without '
+                                                'loading the dataset')
+    quote.add_argument('year', type=int)
+    quote.add_argument('make')
+    quote.add_argument('model', help='model name, or "Not listed"')
+    quote.add_argument('miles', type=int)
+    quote.add_argument('--cache', default='model_cache', help='model cache directory written by a training run')
+    args = parser.parse_args(argv)
+
+    if args.command == 'batch':
+        METRICS.enable(args.metrics or args.metrics_output is not None)
+        quote_batch(args.input, args.output, args.data, args.lazy, args.profile, args.profile_output,
+                    policy_from_arguments(args))
+        if args.metrics_output:
+            write_metrics(args.metrics_output)
+    elif args.command == 'quote':
+        from artifacts import CachedQuoter
+        result = CachedQuoter(args.cache).quote(args.year, args.make, args.model, args.miles)
+        if 'error' in result:
+            print("Error: " + result['error'])
+        else:
+            print("$" + str(result['price']) + " (" + result['confidence'] + ")")
+    else:
+        from app import App
+        app = App(args.metrics, history_path=args.history)
+        app.mainloop()
 
 
 if __name__ == '__main__':
-    app = App()
-    app.mainloop()
+    main()
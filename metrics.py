@@ -0,0 +1,145 @@
+import io
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+
+class Stage:
+    # Times one call of a stage and records it when the with block ends
+    def __init__(self, metrics, name, rows):
+        self.metrics = metrics
+        self.name = name
+        self.rows = rows
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.start, self.rows)
+        return False
+
+
+class Metrics:
+    # Call counts, durations and rows processed of the hot paths of Model, and hit and miss counts of its caches.
+    # While disabled, stage() returns a shared no-op context and count() returns at once, so the instrumented code
+    # pays only an attribute check.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def stage(self, name, rows=0):
+        # with metrics.stage('fit', len(rows)): ...
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, rows)
+
+    def record(self, name, seconds, rows=0, calls=1):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0}
+            stage['calls'] += calls
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            stage['rows'] += rows
+
+    def count(self, name, hit):
+        # Count a hit or a miss of the cache called name
+        if not self.enabled:
+            return
+        with self.lock:
+            counter = self.counters.setdefault(name, {'hits': 0, 'misses': 0})
+            counter['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        # Copy of everything recorded so far
+        with self.lock:
+            return {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'counters': {name: dict(counter) for name, counter in self.counters.items()}}
+
+    def merge(self, snapshot):
+        # Add a snapshot recorded elsewhere, such as in a worker process
+        for name, stage in snapshot['stages'].items():
+            with self.lock:
+                current = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+                current['calls'] += stage['calls']
+                current['seconds'] += stage['seconds']
+                current['max_seconds'] = max(current['max_seconds'], stage['max_seconds'])
+                current['rows'] += stage['rows']
+        for name, counter in snapshot['counters'].items():
+            with self.lock:
+                current = self.counters.setdefault(name, {'hits': 0, 'misses': 0})
+                current['hits'] += counter['hits']
+                current['misses'] += counter['misses']
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+    def to_prometheus(self, prefix='car_price'):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        for metric, field, kind in (('stage_calls_total', 'calls', 'counter'),
+                                    ('stage_seconds_total', 'seconds', 'counter'),
+                                    ('stage_max_seconds', 'max_seconds', 'gauge'),
+                                    ('stage_rows_total', 'rows', 'counter')):
+            lines.append("# TYPE " + prefix + "_" + metric + " " + kind)
+            for name in sorted(snapshot['stages']):
+                lines.append(prefix + "_" + metric + '{stage="' + name + '"} ' + repr(snapshot['stages'][name][field]))
+        for metric, field in (('cache_hits_total', 'hits'), ('cache_misses_total', 'misses')):
+            lines.append("# TYPE " + prefix + "_" + metric + " counter")
+            for name in sorted(snapshot['counters']):
+                lines.append(prefix + "_" + metric + '{cache="' + name + '"} ' + str(snapshot['counters'][name][field]))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        # Lines of text for the metrics window of the app
+        snapshot = self.snapshot()
+        if not self.enabled:
+            return ["Instrumentation is off"]
+        lines = ["Stage, calls, total ms, mean ms, max ms, rows"]
+        for name in sorted(snapshot['stages'], key=lambda stage: -snapshot['stages'][stage]['seconds']):
+            stage = snapshot['stages'][name]
+            lines.append(name + ", " + str(stage['calls']) + ", " + format(stage['seconds'] * 1000, '.2f') + ", "
+                         + format(stage['seconds'] * 1000 / stage['calls'], '.3f') + ", "
+                         + format(stage['max_seconds'] * 1000, '.3f') + ", " + str(stage['rows']))
+        lines.append("Cache, hits, misses, hit rate")
+        for name in sorted(snapshot['counters']):
+            counter = snapshot['counters'][name]
+            total = counter['hits'] + counter['misses']
+            lines.append(name + ", " + str(counter['hits']) + ", " + str(counter['misses']) + ", "
+                         + (format(counter['hits'] / total, '.1%') if total else "-"))
+        return lines
+
+
+def profile_call(function, *args, sort='cumulative', limit=30, path=None):
+    # Run one call under cProfile and return (result, profile text), also saving the raw stats to path if given
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args)
+    if path is not None:
+        profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats(sort).print_stats(limit)
+    return result, text.getvalue()
+
+
+# Returned by stage() while instrumentation is off
+NULL_STAGE = nullcontext()
+
+# Metrics shared by every Model in the process
+METRICS = Metrics()
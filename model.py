@@ -1,316 +1,798 @@
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import warnings
-from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.metrics import r2_score
-from sklearn.model_selection import train_test_split
+import threading
+from importlib.metadata import version
+from artifacts import ArtifactCache
+from global_engine import global_features, train_global
+from loader import clean_listings, merge_summary, summarize_listings
+from metrics import METRICS
+from partitions import PartitionedListings
+from registry import ModelRegistry
+from training import TrainingScheduler, fit_gradient_boost, train_job
+from validation import INSUFFICIENT_ERROR, input_error, whole_number, whole_numbers
+
+
+# Shown instead of a price while a make's models are being trained in the background
+TRAINING = "model training…"
 
 
 class Model:
-    def __init__(self, car_data):
+    def __init__(self, car_data, params=None, cache=None, workers=None, lazy=False, max_models=None, max_bytes=None,
+                 engine='per_make', policy=None, quote_cache=None, max_scatter_points=50000):
+        if engine not in ('per_make', 'global'):
+            raise ValueError("engine must be 'per_make' or 'global'")
+        if engine == 'global' and (lazy or max_models is not None or max_bytes is not None):
+            raise ValueError("lazy training and registry bounds are only available with the per_make engine")
+        # PartitionedListings kept on disk and read one make at a time, or None when car_data is in memory
+        self.partitions = None
+        if isinstance(car_data, PartitionedListings):
+            if engine == 'global':
+                raise ValueError("partitioned listings are only available with the per_make engine")
+            self.partitions = car_data
+            car_data = None
         self.car_data = car_data
+        # 'per_make' fits a GradientBoostingRegressor per make, 'global' one HistGradientBoostingRegressor shared by
+        # every make
+        self.engine = engine
+        # Hyperparameters passed to every regressor
+        self.params = params or {}
+        # Optional training.training_policy() with early stopping and time budgets, None fits every stage
+        self.policy = policy
+        # Optional QuoteCache of recent quote results
+        self.quote_cache = quote_cache
+        # Optional ArtifactCache used to reload fitted models from disk
+        self.cache = cache
+        # Number of training processes, None uses every core and 1 trains serially
+        self.workers = workers
+        # In lazy mode a make's models are only trained on its first quote
+        self.lazy = lazy
         self.overall_accuracy = None
         self.accuracy_with_model = None
         self.accuracy_without_model = None
+        # Seconds spent fitting the models in the reports
+        self.fit_seconds = None
         self.report_with_model = []
         self.report_without_model = []
+        # Fitted prediction models keyed by (make, with_model), optionally bounded by count or approximate bytes
+        self.registry = ModelRegistry(max_models, max_bytes)
+        # r2 score and rating of every trained (make, with_model), None for makes with insufficient data. Scores are
+        # kept when a fitted model is evicted from the registry.
+        self.scores = {}
+        # One lock per make so concurrent quotes don't train the same make twice
+        self.make_locks = {}
+        # Fingerprints of each make's rows, used to save retrained models to the cache
+        self.fingerprints = {}
+        # Makes with new listings whose models have not been retrained yet
+        self.dirty = set()
+        # (make, with_model) keys waiting for a training run in progress, and how many makes that run has finished
+        self.training = set()
+        self.training_done = 0
+        self.training_total = 0
+        # Guards the registry, the dirty makes and the cache against background retraining
+        self.lock = threading.RLock()
+        # Row positions of every make and year, and summary stats per make and year
+        self.make_index = {}
+        self.year_index = {}
+        self.make_stats = {}
+        self.year_stats = {}
+        if self.partitions is None:
+            self.index_rows(self.car_data, 0)
+        else:
+            # Partitioned listings have no row positions, only the stats computed while they were built
+            self.make_index = dict.fromkeys(self.partitions.makes())
+            self.year_index = dict.fromkeys(self.partitions.year_stats)
+            self.make_stats = self.partitions.make_stats
+            self.year_stats = self.partitions.year_stats
+        # Bumped whenever car_data changes, so cached chart data is rebuilt
+        self.data_version = 0
+        self.charts = None
+        # Above max_scatter_points rows graph three draws a density image of the rows instead of every point: the
+        # counts on a grid of density_bins (mileage, price) cells, kept until car_data changes, with one point from
+        # each cell of at most outlier_count rows drawn over it, at most outlier_points of them
+        self.max_scatter_points = max_scatter_points
+        self.density_bins = (200, 150)
+        self.outlier_count = 3
+        self.outlier_points = 1000
+        self.density = None
+        # Groups of at least batch_regressor_rows cars are priced by an entry's sklearn regressor rather than its
+        # exported trees, which are faster for fewer cars
+        self.batch_regressor_rows = 200
+        # Stage timings and cache counters, shared by every model in the process and off unless enabled
+        self.metrics = METRICS
+
+    def index_rows(self, rows, offset):
+        # Add rows that start at position offset of car_data to the make and year indexes and stats
+        for index, stats, column in ((self.make_index, self.make_stats, 'Make'),
+                                     (self.year_index, self.year_stats, 'Year')):
+            for key, positions in rows.groupby(column, sort=False, observed=True).indices.items():
+                positions = positions + offset
+                if isinstance(key, np.generic):
+                    # Store years as plain ints
+                    key = key.item()
+                if key not in index:
+                    index[key] = positions
+                else:
+                    # Merge the new rows into the existing entry
+                    index[key] = np.concatenate([index[key], positions])
+            merge_summary(stats, summarize_listings(rows, column))
+
+    def append_rows(self, rows):
+        # Append new listings to car_data and extend the indexes with them
+        if self.partitions is not None:
+            raise ValueError("partitioned listings can't be appended to, rebuild the partitions instead")
+        rows = rows[self.car_data.columns].reset_index(drop=True)
+        for column in self.car_data.columns:
+            dtype = self.car_data[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                # Grow the categories so the appended column stays categorical
+                categories = dtype.categories.union(pd.Index(rows[column].dropna().unique()))
+                self.car_data[column] = self.car_data[column].cat.set_categories(categories)
+                rows[column] = pd.Categorical(rows[column], categories=categories)
+            else:
+                rows[column] = rows[column].astype(dtype)
+        offset = len(self.car_data)
+        self.car_data = pd.concat([self.car_data, rows], ignore_index=True)
+        self.index_rows(rows, offset)
+        self.data_version += 1
+        return rows
+
+    def rows_for_make(self, make):
+        # All rows of one make, in dataset order
+        if self.partitions is not None:
+            return self.partitions.load(make)
+        return self.car_data.iloc[self.make_index.get(make, [])]
+
+    def make_rows(self, make):
+        # Rows of a make for a training job: a frame, or the make's Partition so the job reads it where it runs
+        if self.partitions is not None:
+            return self.partitions.partitions[make]
+        return self.rows_for_make(make)
 
     def get_years(self):
-        df_years = self.car_data['Year'].unique().tolist()
         year_list = []
-        for year in df_years:
+        for year in self.year_index:
             year_list.append(int(year))
         year_list.sort()
         return year_list
 
     def get_all_makes(self):
-        return self.car_data['Make'].unique()
+        # Makes in the order they first appear in the dataset
+        return list(self.make_index)
 
     def get_all_models(self, make):
-        df_make = self.car_data.query("Make == @make")
+        df_make = self.rows_for_make(make)
         return df_make['Model'].unique()
 
-    def calculate_listing_price(self, year, make, model, mileage):
-        make_miles = self.car_data.query("Make == @make")
-        max_miles = make_miles['Miles'].max()
+    def models_by_make(self):
+        # Sorted model names of every make, without missing models, from one pass over the listings
+        if self.partitions is not None:
+            return {make: sorted(partition.models) for make, partition in self.partitions.partitions.items()}
+        models = {make: [] for make in self.make_index}
+        pairs = self.car_data[['Make', 'Model']].dropna().drop_duplicates()
+        for make, name in zip(pairs['Make'], pairs['Model']):
+            models[str(make)].append(str(name))
+        return {make: sorted(names) for make, names in models.items()}
 
-        if not str.isdigit(mileage):
-            # Check if mileage entry contains anything besides digits
-            prediction = "Error: Mileage must be numbers only"
+    def calculate_listing_price(self, year, make, model, mileage):
+        # Quote a car and format the result for the price label
+        quote = self.quote(year, make, model, mileage)
+        if 'error' in quote:
+            if quote['error'] == TRAINING:
+                return TRAINING
+            prediction = "Error: " + quote['error']
             return prediction
 
-        if (year == "Year") or (make == "Make") or (model == "Model"):
-            # Check if each input field has a valid entry
-            prediction = "Error: fields not complete"
+        prediction = "$" + str(quote['price']) + " " + "(" + quote['confidence'] + ")"
+
+        return prediction
+
+    def quote(self, year, make, model, mileage):
+        # Predict the price of a car, returning {'price', 'confidence'} or {'error'}
+        # Year and mileage must be non-negative whole numbers and every field must be filled in
+        error = input_error(year, make, model, mileage)
+        if error is not None:
+            return {'error': error}
+
+        year = whole_number(year)
+        mileage = whole_number(mileage)
+        if self.quote_cache is None:
+            result = self.predict_quote(year, make, model, mileage)
         else:
-            if model != "Not listed":
-                # Use the data from input fields to create an entry that the model can use for a prediction
-                input_car = pd.DataFrame({'Year': [year], 'Make': [make], 'Model': [model], 'Miles': [mileage]})
-                # Get the prediction model that corresponds with the input data
-                testing_model = Model.gradient_boost(self, make, True)[0]
-                # Get the encoding data so the input car has columns that match the original encoding
-                testing_dummies = Model.gradient_boost(self, make, True)[2]
-                # Use the encoding data to reindex the entry created from the input data
-                testing_columns = input_car.reindex(labels=testing_dummies.columns, axis=1, fill_value=0).drop(
-                    columns=['Price'])
-                # Predict the price of the car
-                prediction = int(testing_model.predict(testing_columns))
-                # Get confidence based on r2 score
-                for item in self.report_with_model:
-                    if item[0] == make:
-                        confidence = item[2]
-                        break
+            # Cars in the same mileage bucket share one cached prediction, made at the middle of the bucket
+            key = self.quote_cache.key(year, make, model, mileage)
+            result = self.quote_cache.get(key)
+            if result is None:
+                generation = self.quote_cache.generation(make)
+                result = self.predict_quote(year, make, model, self.quote_cache.bucket_mileage(key[3]))
+                if 'error' not in result:
+                    self.quote_cache.put(key, result, generation)
+        if 'error' in result:
+            return result
+
+        confidence = result['confidence']
+        if mileage > self.make_stats[make]['max_miles']:
+            # If the input mileage is higher than the maximum mileage value in the dataset, the model can't make an
+            # accurate prediction
+            confidence = "out of range"
+
+        return {'price': result['price'], 'confidence': confidence}
+
+    def predict_quote(self, year, make, model, mileage):
+        # Predict the price of a validated car, returning {'price', 'confidence'} or {'error'}. The out of range check
+        # is left to quote(), which applies it to the exact mileage even when the prediction comes from the cache.
+        with self.metrics.stage('quote', 1):
+            # Look up the fitted prediction model, with "Model" data unless the model is "Not listed"
+            listed = model != "Not listed"
+            if (make, listed) in self.training:
+                # The model is still being trained in the background
+                return {'error': TRAINING}
+            entry = self.fetch_entry(make, listed)
+            if entry is not None and listed and not Model.knows(entry, make, model):
+                # Model names the make was not trained on are priced without model data
+                if (make, False) in self.training:
+                    return {'error': TRAINING}
+                entry = self.fetch_entry(make, False)
+            if entry is None:
+                # Makes with too few entries never get a prediction model
+                return {'error': INSUFFICIENT_ERROR}
+
+            # Use the data from input fields to create an entry that the model can use for a prediction
+            if 'encoder' in entry:
+                with self.metrics.stage('encode_features', 1):
+                    testing_columns = entry['encoder'].transform_one(year, model, mileage)
             else:
-                # If the "Model" input is "Not listed", use the prediction model without "Model" data
-                input_car = pd.DataFrame({'Year': [year], 'Miles': [mileage]})
-                testing_model = Model.gradient_boost(self, make, False)[0]
-                prediction = int(testing_model.predict(input_car))
-                for item in self.report_without_model:
-                    if item[0] == make:
-                        confidence = item[2]
-                        break
+                input_car = pd.DataFrame({'Year': [year], 'Model': [model], 'Miles': [mileage]})
+                testing_columns = Model.features(entry, make, input_car)
+            # Predict the price of the car
+            with self.metrics.stage('predict', 1):
+                prediction = int(entry['regressor'].predict(testing_columns)[0])
+        # Get confidence based on r2 score
+        confidence = entry['rating']
+
         # Assign a confidence value
         if prediction < 1000:
             # Predictions below $1000 are considered inaccurate
             confidence = "weak"
-        if int(mileage) > int(max_miles):
-            # If the input mileage is higher than the maximum mileage value in the dataset, the model can't make an
-            # accurate prediction
-            confidence = "out of range"
 
-        prediction = "$" + str(prediction) + " " + "(" + confidence + ")"
+        return {'price': prediction, 'confidence': confidence}
 
-        return prediction
+    @staticmethod
+    def knows(entry, make, models):
+        # Whether a with model entry was trained on the model names, for one name or an array of names
+        if entry.get('engine') == 'global':
+            codes = entry['model_codes'].get(make, {})
+            if isinstance(models, str):
+                return models in codes
+            return np.array([isinstance(name, str) and name in codes for name in models], dtype=bool)
+        return entry['encoder'].knows(models)
+
+    @staticmethod
+    def features(entry, make, cars):
+        # Turn cars with Year, Model and Miles columns into the features of a registry entry's regressor
+        if entry.get('engine') == 'global':
+            with METRICS.stage('global_features', len(cars)):
+                return global_features(entry, make, cars)
+        # Encode the cars with the make's fitted encoder
+        with METRICS.stage('encode_features', len(cars)):
+            return entry['encoder'].transform(cars['Year'], cars['Miles'], cars['Model'])
+
+    def calculate_listing_prices(self, frame):
+        # Price a batch of cars given as a frame with Year, Make, Model and Miles columns
+        # Returns a copy of the frame with "Predicted Price" and "Confidence" columns added
+        cars = pd.DataFrame({'Year': whole_numbers(frame['Year']),
+                             'Make': frame['Make'].to_numpy(),
+                             'Model': frame['Model'].to_numpy() if 'Model' in frame else "Not listed",
+                             'Miles': whole_numbers(frame['Miles'])})
+        prices = np.full(len(cars), np.nan)
+        confidences = np.full(len(cars), "no model", dtype=object)
+        # Rows whose year or mileage is not a non-negative whole number can't be priced, like single quotes
+        valid = cars['Year'].notna() & cars['Miles'].notna()
+        confidences[~valid.to_numpy()] = "invalid"
+        # Cars with a listed model use the prediction model with "Model" data
+        listed = cars['Model'].notna() & (cars['Model'] != "Not listed")
+
+        for (make, model), group in cars[valid].groupby([cars['Make'], listed], sort=False):
+            if (make, model) in self.training:
+                confidences[group.index] = TRAINING
+                continue
+            entry = self.fetch_entry(make, model)
+            if entry is None:
+                # Unknown makes and makes with insufficient data keep the "no model" confidence
+                continue
+            if model:
+                known = Model.knows(entry, make, group['Model'])
+                if not known.all():
+                    # Model names the make was not trained on are priced without model data
+                    if (make, False) in self.training:
+                        confidences[group.index[~known]] = TRAINING
+                    else:
+                        self.price_group(make, self.fetch_entry(make, False), group[~known], prices, confidences)
+                    group = group[known]
+            self.price_group(make, entry, group, prices, confidences)
+
+        quotes = frame.copy()
+        quotes['Predicted Price'] = pd.Series(prices, index=frame.index).astype('Int64')
+        quotes['Confidence'] = confidences
+        return quotes
+
+    def price_group(self, make, entry, group, prices, confidences):
+        # Predict a group of cars of one make in one call and write their prices and confidences by row position
+        if entry is None or not len(group):
+            return
+        features = Model.features(entry, make, group)
+        regressor = entry['regressor']
+        if len(group) >= self.batch_regressor_rows and 'batch_regressor' in entry:
+            regressor = entry['batch_regressor']
+        with self.metrics.stage('predict', len(group)):
+            predicted = regressor.predict(features).astype(int)
+        # Assign a confidence value with the same rules as a single quote
+        confidence = np.full(len(group), entry['rating'], dtype=object)
+        confidence[predicted < 1000] = "weak"
+        confidence[group['Miles'].to_numpy() > self.make_stats[make]['max_miles']] = "out of range"
+        prices[group.index] = predicted
+        confidences[group.index] = confidence
+
+    def chart_data(self):
+        # Aggregates behind the graphs, computed in one groupby pass per column and kept until car_data changes
+        fresh = self.charts is not None and self.charts['version'] == self.data_version
+        self.metrics.count('chart_data', fresh)
+        if not fresh and self.partitions is not None:
+            # The means come from the stats of every row and the scatter plot from the sample taken while building
+            years = sorted(self.year_stats)
+            self.charts = {
+                'version': self.data_version,
+                'years': years,
+                'year_prices': [int(self.year_stats[year]['mean_price']) for year in years],
+                'makes': [str(make) for make in self.make_stats],
+                'make_prices': [int(stats['mean_price']) for stats in self.make_stats.values()],
+                'miles': self.partitions.sample['Miles'],
+                'prices': self.partitions.sample['Price'],
+            }
+        elif not fresh:
+            by_year = self.car_data.groupby('Year', observed=True)['Price'].mean().sort_index()
+            by_make = self.car_data.groupby('Make', observed=True, sort=False)['Price'].mean()
+            self.charts = {
+                'version': self.data_version,
+                'years': [int(year) for year in by_year.index],
+                'year_prices': by_year.astype(int).tolist(),
+                'makes': [str(make) for make in by_make.index],
+                'make_prices': by_make.astype(int).tolist(),
+                'miles': self.car_data['Miles'].to_numpy(),
+                'prices': self.car_data['Price'].to_numpy(),
+            }
+        return self.charts
 
-    def generate_graph_one(self):
-        # Average selling price by year
-        years = self.get_years()
-        avg_sale_price = []
+    @staticmethod
+    def reset_figure(fig):
+        # Clear a figure that is being redrawn, or create a new one that isn't tracked by pyplot so it can be freed.
+        # matplotlib is only imported once a graph is drawn, so headless use of Model never loads it.
+        if fig is None:
+            from matplotlib.figure import Figure
+            fig = Figure()
+        fig.clear()
+        return fig, fig.add_subplot()
 
-        # Average sale price per year chronologically
-        for year in years:
-            query_year = str(year)
-            year_sales = self.car_data.query("Year == @query_year")
-            average = year_sales['Price'].mean()
-            avg_sale_price.append(int(average))
+    def generate_graph_one(self, fig=None):
+        # Average selling price by year, chronologically
+        charts = self.chart_data()
 
         # Create a plot
-        x = years
-        y = avg_sale_price
-        fig, ax = plt.subplots()
+        x = charts['years']
+        y = charts['year_prices']
+        fig, ax = Model.reset_figure(fig)
         ax.bar(x, y)
-        plt.title("Average sale price by year")
-        plt.xlabel("Year")
-        plt.ylabel("Sale Price")
+        ax.set_title("Average sale price by year")
+        ax.set_xlabel("Year")
+        ax.set_ylabel("Sale Price")
         return fig
 
-    def generate_graph_two(self):
+    def generate_graph_two(self, fig=None):
         # Average selling price by make
-        makes = self.get_all_makes()
-        avg_sale_prices = []
-
-        for make in makes:
-            df_make_sales = self.car_data.query("Make == @make")
-            avg_price = df_make_sales['Price'].mean()
-            avg_sale_prices.append(int(avg_price))
+        charts = self.chart_data()
 
         # Create a plot
-        x = makes
-        y = avg_sale_prices
-        fig, ax = plt.subplots()
+        x = charts['makes']
+        y = charts['make_prices']
+        fig, ax = Model.reset_figure(fig)
         ax.bar(x, y)
-        plt.title("Average selling price by manufacturer")
-        plt.xlabel("Manufacturer")
-        plt.xticks(rotation=90, ha='right')
-        plt.ylabel("Average Sale Price")
+        ax.set_title("Average selling price by manufacturer")
+        ax.set_xlabel("Manufacturer")
+        ax.tick_params(axis='x', labelrotation=90)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+        ax.set_ylabel("Average Sale Price")
         return fig
 
-    def generate_graph_three(self):
-        # Scatter plot of correlation between year, miles and price
-        x = self.car_data['Miles']
-        y = self.car_data['Price']
-        fig, ax = plt.subplots()
-        ax.scatter(x, y, c='red', s=1)
-        plt.title("Correlation between mileage and sale price")
-        plt.xlabel("Mileage")
-        plt.xticks(ha='right')
-        plt.ylabel("Sale price")
-        return fig
+    def scatter_density(self):
+        # Counts of the graph three points in each cell of the density grid, and the sparse cell points drawn over
+        # them, computed in one pass over the rows and kept until car_data changes
+        fresh = self.density is not None and self.density['version'] == self.data_version
+        self.metrics.count('scatter_density', fresh)
+        if fresh:
+            return self.density
+        charts = self.chart_data()
+        miles = charts['miles']
+        prices = charts['prices']
+        columns, rows = self.density_bins
+        with self.metrics.stage('scatter_density', len(miles)):
+            low_miles, high_miles = int(miles.min()), int(miles.max())
+            low_price, high_price = int(prices.min()), int(prices.max())
+            cells = (Model.bin_positions(miles, low_miles, high_miles, columns) * rows
+                     + Model.bin_positions(prices, low_price, high_price, rows))
+            counts = np.bincount(cells, minlength=columns * rows)
+            # One point from each sparse cell, so outliers stay visible where the image is faintest
+            sparse = np.flatnonzero(counts[cells] <= self.outlier_count)
+            _, first = np.unique(cells[sparse], return_index=True)
+            outliers = sparse[first]
+            if len(outliers) > self.outlier_points:
+                outliers = np.sort(np.random.default_rng(0).choice(outliers, self.outlier_points, replace=False))
+        self.density = {
+            'version': self.data_version,
+            'counts': counts.reshape(columns, rows),
+            'extent': (low_miles, max(high_miles, low_miles + 1), low_price, max(high_price, low_price + 1)),
+            'outlier_miles': miles[outliers],
+            'outlier_prices': prices[outliers],
+        }
+        return self.density
 
-    def encode(self, make):
-        # Encode the columns and drop outliers
-        # Load dataset
-        df_maker = self.car_data.query('Make == @make')
-        df_maker = df_maker.drop(columns=['Make'])
-        # Remove outlier prices
-        mean = df_maker["Price"].mean()
-        deviation = df_maker["Price"].std()
-        df_maker = df_maker[(df_maker['Year'] <= mean + (3*deviation))]
-        # Encode 'model' column
-        df_maker_encoded = pd.get_dummies(df_maker, columns=['Model'], drop_first=True)
-        # Save the encoded columns so they can be used for prediction of a new entry
-        x = df_maker_encoded
-        return x
+    @staticmethod
+    def bin_positions(values, low, high, count):
+        # Cell of each value on a grid of count equal cells from low to high
+        scale = count / max(high - low, 1)
+        return np.minimum(((values - low) * scale).astype(np.intp), count - 1)
+
+    def generate_graph_three(self, fig=None, density=None):
+        # Scatter plot of correlation between year, miles and price. With density, or by default above
+        # max_scatter_points rows, the points are drawn as a density image so the time to draw it does not grow with
+        # the number of rows.
+        charts = self.chart_data()
+        x = charts['miles']
+        y = charts['prices']
+        if density is None:
+            density = len(x) > self.max_scatter_points
+        fig, ax = Model.reset_figure(fig)
+        if density:
+            from matplotlib.colors import LogNorm
+            grid = self.scatter_density()
+            counts = np.ma.masked_equal(grid['counts'].T, 0)
+            image = ax.imshow(counts, origin='lower', extent=grid['extent'], aspect='auto', cmap='Reds',
+                              norm=LogNorm(vmin=1, vmax=max(int(counts.max()), 2)), interpolation='nearest')
+            # Minor ticks on the log scale cost more to lay out than the whole image
+            fig.colorbar(image, ax=ax, label="Listings").minorticks_off()
+            if self.outlier_points:
+                ax.scatter(grid['outlier_miles'], grid['outlier_prices'], c='black', s=0.5)
+        else:
+            ax.scatter(x, y, c='red', s=1)
+        ax.set_title("Correlation between mileage and sale price")
+        ax.set_xlabel("Mileage")
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+        ax.set_ylabel("Sale price")
+        return fig
 
     def gradient_boost(self, make, model):
         # Generate a gradient boost regression model
-        results = []
-
-        if model:
-            # Generate a prediction model that includes "model" data
-            # Encode the model column
-            data = Model.encode(self, make)
-            dummies = data
-            # Define dependent and independent variables
-            x = data.drop('Price', axis=1)
-            y = data['Price']
-            # Split the data into training and testing sets
-            X_train, X_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
-            # Create and train the Gradient Boosting model
-            model_with = GradientBoostingRegressor()
-            model_with.fit(X_train, y_train)
-            # Test prediction model
-            y_pred = model_with.predict(X_test)
-            # Get the model's r2 score
-            r2_with = r2_score(y_test, y_pred)
-            # Save the prediction model, r2 score, and encoded columns
-            results.append(model_with)
-            results.append(r2_with)
-            results.append(dummies)
-        else:
-            # Generate a prediction model that does not include "model" data
-            data = self.car_data.query('Make == @make')
-            data = data.drop(columns=['Make', 'Model'])
-            # Define dependent and independent variables
-            x = data.drop('Price', axis=1)
-            y = data['Price']
-            # Split the data into training and testing sets
-            X_train, X_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
-            # Create and train the Gradient Boosting model
-            model_without = GradientBoostingRegressor()
-            model_without.fit(X_train, y_train)
-            # Test the prediction model
-            y_pred = model_without.predict(X_test)
-            # Get the model's r2 score
-            r2_without = r2_score(y_test, y_pred)
-            # Save the prediction model and r2 score
-            results.append(model_without)
-            results.append(r2_without)
-        return results
-
-    def generate_gradient_boost_model(self):
+        return fit_gradient_boost(self.rows_for_make(make), model, self.params, self.policy)
+
+    def train_make(self, make, model):
+        # Generate a prediction model for one make and save it to the registry
+        entry = train_job(make, model, self.rows_for_make(make), self.params, self.policy)
+        self.store_entry(make, model, entry)
+        return entry
+
+    def store_entry(self, make, model, entry, save=True):
+        # Save a trained model to the registry, and to the cache when one is used
+        with self.lock:
+            if entry is None:
+                self.registry.pop((make, model), None)
+                self.scores[(make, model)] = None
+            else:
+                self.registry[(make, model)] = entry
+                self.scores[(make, model)] = {'r2': entry['r2'], 'rating': entry['rating'],
+                                              'stages': entry.get('stages'), 'fit_seconds': entry.get('fit_seconds')}
+            if self.quote_cache is not None:
+                # Quotes of the make's previous models are stale
+                self.quote_cache.invalidate_make(make)
+            if save and self.cache is not None and make in self.fingerprints:
+                self.cache.save(make, model, self.fingerprints[make], entry)
+
+    def training_settings(self):
+        # Everything besides the data that changes the fitted models. The sklearn version is read from its package
+        # metadata, which is much cheaper than importing it.
+        return {'engine': self.engine, 'params': self.params, 'test_size': 0.2, 'random_state': 42,
+                'features': 'encoder', 'predictor': 'trees+sklearn', 'policy': self.policy,
+                'sklearn': version('scikit-learn')}
+
+    def fingerprint_makes(self):
+        # Fingerprints of every make's rows. Partitioned listings are hashed one make at a time, which gives the same
+        # fingerprints as hashing the whole frame, so both share cached models.
+        if self.partitions is None:
+            return ArtifactCache.fingerprint_makes(self.car_data, self.training_settings())
+        fingerprints = {}
+        for make in self.get_all_makes():
+            fingerprints.update(ArtifactCache.fingerprint_makes(self.rows_for_make(make), self.training_settings()))
+        return fingerprints
+
+    def write_cache_manifest(self):
+        # Record the fingerprints of the saved models, and the highest mileage of every make for CachedQuoter
+        with self.lock:
+            self.cache.write_manifest(ArtifactCache.fingerprint_dataset(self.fingerprints),
+                                      {str(make): stats['max_miles'] for make, stats in self.make_stats.items()})
+
+    def begin_training(self):
+        # Mark every model as waiting for training, so quotes report TRAINING instead of training the make themselves.
+        # Called before starting generate_gradient_boost_model on another thread.
+        if self.lazy:
+            return
+        with self.lock:
+            self.training = {(make, model) for make in self.get_all_makes() for model in (True, False)}
+            self.training_done = 0
+            self.training_total = len(self.make_index)
+
+    def finish_training(self, make, model, progress=None):
+        # A model of the training run is in the registry. Once both of a make's models are, the make counts as done.
+        with self.lock:
+            self.training.discard((make, model))
+            if (make, not model) in self.training:
+                return
+            self.training_done += 1
+            done = self.training_done
+        self.update_accuracy()
+        if progress is not None:
+            progress(done, self.training_total)
+
+    def generate_gradient_boost_model(self, progress=None):
+        # Train or reload every make's models. progress is called with (makes done, total makes) as each make becomes
+        # quotable, from the thread running the training.
+        if self.cache is not None:
+            self.fingerprints = self.fingerprint_makes()
+        if self.engine == 'global':
+            self.begin_training()
+            try:
+                self.generate_global_model()
+            finally:
+                with self.lock:
+                    self.training = set()
+            if progress is not None:
+                progress(self.training_total, self.training_total)
+            return self.registry
+        if self.lazy:
+            # Every make is trained, or reloaded from the cache, on its first quote
+            self.update_accuracy()
+            return self.registry
+        self.begin_training()
+        try:
+            # Collect a training job for every make with and without model data
+            jobs = []
+            for model in (True, False):
+                for make in self.get_all_makes():
+                    if self.cache is not None:
+                        # Reload the saved model if the make's rows have not changed since it was trained
+                        found, entry = self.cache.load(make, model, self.fingerprints[make])
+                        if found:
+                            self.store_entry(make, model, entry, save=False)
+                            self.finish_training(make, model, progress)
+                            continue
+                    jobs.append((make, model, self.make_rows(make)))
+            # Train the remaining jobs in parallel
+            for (make, model), entry in TrainingScheduler(self.workers).run(jobs, self.params, self.policy):
+                self.store_entry(make, model, entry)
+                self.finish_training(make, model, progress)
+        finally:
+            # After a failed run the remaining makes are trained on their first quote instead
+            with self.lock:
+                self.training = set()
+        if self.cache is not None:
+            self.write_cache_manifest()
+        # The reports are rebuilt in make order, so they do not depend on the order the jobs finished in
+        self.update_accuracy()
+        return self.registry
+
+    def fetch_entry(self, make, model):
+        # Return the fitted model of (make, model), first reloading or training the make if it is not in memory
+        if make in self.dirty:
+            # Retrain a make with new listings before quoting it
+            self.retrain_dirty([make])
+        with self.lock:
+            entry = self.registry.get((make, model))
+        self.metrics.count('registry', entry is not None or self.scores.get((make, model), "pending") is None)
+        if entry is None and make in self.make_index and self.scores.get((make, model), "pending") is not None:
+            # The make is still pending in lazy mode, or its model was evicted
+            entry = self.load_make(make)[model]
+        return entry
+
+    def load_make(self, make):
+        # Reload both models of a make from the cache, or train them, and return them keyed by with_model
+        with self.lock:
+            make_lock = self.make_locks.setdefault(make, threading.Lock())
+        loaded = {}
+        trained = False
+        with make_lock:
+            for model in (True, False):
+                with self.lock:
+                    entry = self.registry.get((make, model))
+                if entry is not None or self.scores.get((make, model), "pending") is None:
+                    # Already loaded by another quote, or the make has insufficient data
+                    loaded[model] = entry
+                    continue
+                if self.cache is not None:
+                    if make not in self.fingerprints:
+                        self.fingerprints.update(
+                            ArtifactCache.fingerprint_makes(self.rows_for_make(make), self.training_settings()))
+                    found, entry = self.cache.load(make, model, self.fingerprints[make])
+                    if found:
+                        self.store_entry(make, model, entry, save=False)
+                        loaded[model] = entry
+                        continue
+                loaded[model] = self.train_make(make, model)
+                trained = True
+        if trained and self.cache is not None:
+            self.write_cache_manifest()
+        self.update_accuracy()
+        return loaded
+
+    def trained_makes(self):
+        # Makes whose models have been trained or reloaded at least once
+        return [make for make in self.get_all_makes() if (make, True) in self.scores]
+
+    def pending_makes(self):
+        # Makes that have not been trained yet, in lazy mode
+        return [make for make in self.get_all_makes() if (make, True) not in self.scores]
+
+    def generate_global_model(self):
+        # Train the shared models over every make, or reload them from the cache while the dataset is unchanged
+        if self.cache is not None:
+            self.fingerprints = ArtifactCache.fingerprint_makes(self.car_data, self.training_settings())
+            fingerprint = ArtifactCache.fingerprint_dataset(self.fingerprints)
+            # The whole set of entries is saved as one artifact under a name that can't be a make
+            found, entries = self.cache.load('*global*', True, fingerprint)
+        if self.cache is None or not found:
+            entries = train_global(self.car_data, self.params, self.policy)
+            if self.cache is not None:
+                with self.lock:
+                    self.cache.save('*global*', True, fingerprint, entries)
+                    self.cache.write_manifest(fingerprint)
+        for (make, model), entry in entries.items():
+            self.store_entry(make, model, entry, save=False)
+        self.update_accuracy()
+
+    def add_listings(self, listings, background=False):
+        # Append new listings and retrain only the makes they belong to. The retraining runs in a background thread,
+        # or lazily on the next quote for each make.
+        if 'Name' in listings.columns:
+            # Raw listings in the carvana.csv format
+            listings = clean_listings(listings)
+        rows = self.append_rows(listings)
+        with self.lock:
+            makes = [str(make) for make in rows['Make'].dropna().unique()]
+            self.dirty.update(makes)
+        if self.quote_cache is not None:
+            # Quotes of these makes must not skip the retraining their next quote triggers
+            for make in makes:
+                self.quote_cache.invalidate_make(make)
+        if background:
+            thread = threading.Thread(target=self.retrain_dirty, daemon=True)
+            thread.start()
+            return thread
+        return None
+
+    def retrain_dirty(self, makes=None):
+        # Retrain every make with new listings, or only the given makes if they have new listings
+        with self.lock:
+            if self.engine == 'global':
+                # The shared models are retrained as a whole, so they take in every pending make at once
+                makes = None
+            claimed = [make for make in (self.dirty.copy() if makes is None else makes) if make in self.dirty]
+            self.dirty.difference_update(claimed)
+        if claimed:
+            try:
+                self.retrain_makes(claimed)
+            except BaseException:
+                # Keep the makes dirty so their next quote or retrain tries again instead of using the stale models
+                with self.lock:
+                    self.dirty.update(claimed)
+                raise
+        return claimed
+
+    def retrain_makes(self, makes):
+        # Retrain both models of the given makes and update the reports without touching the other makes
+        if self.engine == 'global':
+            # Every make shares the global models, so they are retrained as a whole
+            self.generate_global_model()
+            return
+        if self.cache is not None:
+            for make in makes:
+                fingerprint = ArtifactCache.fingerprint_makes(self.rows_for_make(make), self.training_settings())
+                self.fingerprints.update(fingerprint)
+        jobs = [(make, model, self.make_rows(make)) for model in (True, False) for make in makes]
+        for (make, model), entry in TrainingScheduler(self.workers).run(jobs, self.params, self.policy):
+            self.store_entry(make, model, entry)
+        if self.cache is not None:
+            self.write_cache_manifest()
+        self.update_accuracy()
+
+    def update_accuracy(self):
+        # Rebuild the per make reports and overall r2 averages from the saved scores
         # list of all scores
         all_scores = []
-        # list of scores with model info
-        scores_with_model = []
-        # list of scores without model info
-        scores_without_model = []
-        # list of makes with insufficient samples for accurate model
-        insufficient = []
-        # encoded columns
-        dummies = None
-        # Generate models for all makes (with model data)
-        for make in self.get_all_makes():
-            with warnings.catch_warnings():
-                warnings.filterwarnings('error')
-                try:
-                    # Generate a prediction model
-                    model = Model.gradient_boost(self, make, True)
-                    score_with = model[1]
-                    dummies = model[2]
-                    # Assign a confidence metric
-                    if score_with < 0:
-                        rating_with = "negative"
-                    elif (score_with > 0) and (score_with < 0.3):
-                        rating_with = "weak"
-                        scores_with_model.append(score_with)
-                        scores_with_model.append(dummies)
-                        all_scores.append(score_with)
-                    elif (score_with >= 0.3) and (score_with <= 0.7):
-                        rating_with = "moderate"
-                        scores_with_model.append(score_with)
-                        scores_with_model.append(dummies)
-                        all_scores.append(score_with)
-                    elif score_with > 0.7:
-                        rating_with = "strong"
-                        scores_with_model.append(score_with)
-                        scores_with_model.append(dummies)
-                        all_scores.append(score_with)
-                    # Save the model and relevant data
-                    self.report_with_model.append([make, score_with, rating_with])
-                except Warning:
-                    # Separate the manufacturers with insufficient entries for an accurate prediction model
-                    insufficient.append(make)
-
-        # Generate models for all makes (without model data)
-        for make in self.get_all_makes():
-            with warnings.catch_warnings():
-                warnings.filterwarnings('error')
-                try:
-                    # Generate a prediction model
-                    model = Model.gradient_boost(self, make, False)
-                    score_without = model[1]
-                    # Assign a confidence metric
-                    if score_without < 0:
-                        rating_without = "negative"
-                    elif (score_without > 0) and (score_without < 0.3):
-                        rating_without = "weak"
-                        scores_without_model.append(score_without)
-                        all_scores.append(score_without)
-                    elif (score_without >= 0.3) and (score_without <= 0.7):
-                        rating_without = "moderate"
-                        scores_without_model.append(score_without)
-                        all_scores.append(score_without)
-                    elif score_without > 0.7:
-                        rating_without = "strong"
-                        scores_without_model.append(score_without)
-                        all_scores.append(score_without)
-                    # Save the model and relevant data
-                    self.report_without_model.append([make, score_without, rating_without])
-                except Warning:
-                    pass
+        # Build the reports before replacing the old ones, so readers on other threads never see them half built
+        report_with_model = []
+        report_without_model = []
+        with self.lock:
+            for make in self.get_all_makes():
+                score = self.scores.get((make, True))
+                if score is not None:
+                    report_with_model.append([make, score['r2'], score['rating'], score['stages'],
+                                              score['fit_seconds']])
+            for make in self.get_all_makes():
+                score = self.scores.get((make, False))
+                if score is not None:
+                    report_without_model.append([make, score['r2'], score['rating'], score['stages'],
+                                                 score['fit_seconds']])
 
         # Calculate average r2 score with and without model
         sum_with = 0
         sum_without = 0
         len_with = 0
         len_without = 0
-        for entry in self.report_with_model:
+        for entry in report_with_model:
             rscore_with = entry[1]
-            if rscore_with < 0:
+            if entry[2] != "negative":
+                all_scores.append(rscore_with)
+            if rscore_with >= 0:
                 # Exclude negative r2 values
-                sum_with += 0
-            else:
                 sum_with += rscore_with
                 len_with += 1
-        for entry in self.report_without_model:
+        for entry in report_without_model:
             rscore_without = entry[1]
-            if rscore_without < 0:
-                sum_without += 0
-            else:
+            if entry[2] != "negative":
+                all_scores.append(rscore_without)
+            if rscore_without >= 0:
                 sum_without += rscore_without
                 len_without += 1
 
-        # Save the overall r2 averages
-        self.overall_accuracy = (sum(all_scores)) / len(all_scores)
-        self.accuracy_with_model = sum_with / len_with
-        self.accuracy_without_model = sum_without / len_without
-        return dummies
+        # Save the reports and the overall r2 averages
+        self.report_with_model = report_with_model
+        self.report_without_model = report_without_model
+        self.overall_accuracy = sum(all_scores) / len(all_scores) if all_scores else None
+        self.accuracy_with_model = sum_with / len_with if len_with else None
+        self.accuracy_without_model = sum_without / len_without if len_without else None
+        # The global engine fits one shared model, whose fit time is repeated on every make
+        fit_times = [entry[4] for entry in report_with_model + report_without_model if entry[4] is not None]
+        if self.engine == 'global':
+            fit_times = sorted(set(fit_times))
+        self.fit_seconds = sum(fit_times) if fit_times else None
 
     def generate_accuracy_report(self):
-        # First line of accuracy report contains overall averages
-        entries = [[self.overall_accuracy, self.accuracy_with_model, self.accuracy_without_model]]
+        # First line of accuracy report contains overall averages and the total fit time
+        entries = [[self.overall_accuracy, self.accuracy_with_model, self.accuracy_without_model, self.fit_seconds]]
         # Subsequent lines contain data for each manufacturer
-        for entry in self.report_with_model[1:]:
-            make = entry[0]
-            rating_with = entry[2]
-            r2_with = entry[1]
+        for make in self.get_all_makes():
+            if (make, True) not in self.scores:
+                # Makes that have not been trained yet in lazy mode
+                entries.append([make, "pending", "pending", None, None, None, None, None, None])
+                continue
+            for entry in self.report_with_model:
+                if entry[0] == make:
+                    rating_with = entry[2]
+                    r2_with = entry[1]
+                    stages_with = entry[3]
+                    seconds_with = entry[4]
+                    break
+            else:
+                # Makes with insufficient data are left out of the report
+                continue
             rating_without = None
             r2_without = None
+            stages_without = None
+            seconds_without = None
             for item in self.report_without_model:
-                if item[0] == entry[0]:
+                if item[0] == make:
                     rating_without = item[2]
                     r2_without = item[1]
-            entries.append([make, rating_with, rating_without, r2_with, r2_without])
+                    stages_without = item[3]
+                    seconds_without = item[4]
+            entries.append([make, rating_with, rating_without, r2_with, r2_without, stages_with, stages_without,
+                            seconds_with, seconds_without])
         return entries
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from loader import CSV_COLUMNS, CSV_DTYPES, clean_listings, load_dataset, merge_summary, summarize_listings
+
+# Columns stored in every partition and their types. Model is stored as codes into the partition's list of models.
+PARTITION_COLUMNS = {'Year': 'int16', 'Miles': 'int32', 'Price': 'int32', 'Model': 'int32'}
+
+
+class Reservoir:
+    # Uniform sample of at most capacity rows from a stream of column arrays (reservoir sampling, algorithm R)
+    def __init__(self, capacity, rng):
+        self.capacity = capacity
+        self.rng = rng
+        self.columns = None
+        # Rows offered so far
+        self.seen = 0
+
+    def __len__(self):
+        return 0 if self.columns is None else len(next(iter(self.columns.values())))
+
+    def add(self, columns):
+        count = len(next(iter(columns.values())))
+        # Fill the free slots with the first rows
+        free = min(self.capacity - len(self), count)
+        if self.columns is None:
+            self.columns = {name: values[:free].copy() for name, values in columns.items()}
+        elif free > 0:
+            self.columns = {name: np.concatenate([self.columns[name], columns[name][:free]])
+                            for name in self.columns}
+        if free < count:
+            # Row number t of the stream replaces a random slot with probability capacity / (t + 1). When two rows of
+            # this batch pick the same slot the later one wins, as if they were offered one at a time.
+            positions = np.arange(max(free, 0), count)
+            slots = self.rng.integers(0, self.seen + positions + 1)
+            accepted = slots < self.capacity
+            positions = positions[accepted][::-1]
+            slots, last = np.unique(slots[accepted][::-1], return_index=True)
+            for name in self.columns:
+                self.columns[name][slots] = columns[name][positions[last]]
+        self.seen += count
+
+
+class Partition:
+    # The rows of one make in a directory of one raw binary file per column, loaded when the make is trained
+    def __init__(self, directory, make, rows, models):
+        self.directory = directory
+        self.make = make
+        self.rows = rows
+        # Model names in the order of their codes
+        self.models = models
+
+    def __len__(self):
+        return self.rows
+
+    def load(self):
+        # The make's rows in the same layout as Model.rows_for_make
+        return self.frame({name: np.fromfile(os.path.join(self.directory, name + '.bin'), dtype=dtype)
+                           for name, dtype in PARTITION_COLUMNS.items()})
+
+    def frame(self, columns):
+        # Turn arrays of PARTITION_COLUMNS into a frame with the columns and types of the in memory listings
+        rows = len(columns['Year'])
+        return pd.DataFrame({'Year': columns['Year'],
+                             'Make': pd.Categorical.from_codes(np.zeros(rows, dtype=np.int8), [self.make]),
+                             'Model': pd.Categorical.from_codes(columns['Model'], self.models).set_categories(
+                                 sorted(self.models)),
+                             'Miles': columns['Miles'],
+                             'Price': columns['Price']})
+
+    def append(self, columns):
+        # Append rows given as arrays of PARTITION_COLUMNS to the column files
+        for name, dtype in PARTITION_COLUMNS.items():
+            with open(os.path.join(self.directory, name + '.bin'), 'ab') as column_file:
+                column_file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.rows += len(columns['Year'])
+
+
+class PartitionedListings:
+    # Listings split by make into partitions on disk, built from a CSV read in chunks so no more than one chunk is in
+    # memory at a time. The make and year stats cover every row that was read, and a fixed size sample of all rows
+    # is kept for the scatter graph. Training reads one make's partition at a time, so its memory use is bounded by
+    # the largest make instead of the whole dataset.
+    manifest_name = 'partitions.json'
+
+    def __init__(self, directory, partitions, make_stats, year_stats, sample):
+        self.directory = directory
+        # Partition of every make, in the order the makes first appear in the CSV
+        self.partitions = partitions
+        self.make_stats = make_stats
+        self.year_stats = year_stats
+        # {'Miles': array, 'Price': array} sampled from every row
+        self.sample = sample
+
+    @classmethod
+    def build(cls, csv_path, directory, chunksize=100000, max_rows_per_make=None, sample_rows=20000, seed=0):
+        # Read a listings CSV in chunks of chunksize rows into per make partitions under directory. With
+        # max_rows_per_make, each make keeps a uniform sample of at most that many rows instead of all of them.
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        partitions = {}
+        # Code of every model name within its make's partition
+        model_codes = {}
+        reservoirs = {}
+        make_stats = {}
+        year_stats = {}
+        sample = Reservoir(sample_rows, rng)
+        for raw in pd.read_csv(csv_path, usecols=CSV_COLUMNS, dtype=CSV_DTYPES, chunksize=chunksize):
+            chunk = clean_listings(raw)
+            merge_summary(make_stats, summarize_listings(chunk, 'Make'))
+            merge_summary(year_stats, summarize_listings(chunk, 'Year'))
+            sample.add({'Miles': chunk['Miles'].to_numpy(), 'Price': chunk['Price'].to_numpy()})
+            chunk_models = chunk['Model'].cat.categories
+            chunk_codes = chunk['Model'].cat.codes.to_numpy()
+            for make, positions in chunk.groupby('Make', sort=False, observed=True).indices.items():
+                make = str(make)
+                if make not in partitions:
+                    # A fresh directory per make, emptied of any earlier build
+                    partition_directory = os.path.join(
+                        directory, format(len(partitions), '05d') + '-' + re.sub(r'[^A-Za-z0-9_-]', '_', make))
+                    os.makedirs(partition_directory, exist_ok=True)
+                    for name in PARTITION_COLUMNS:
+                        open(os.path.join(partition_directory, name + '.bin'), 'wb').close()
+                    partitions[make] = Partition(partition_directory, make, 0, [])
+                    model_codes[make] = {}
+                    if max_rows_per_make is not None:
+                        reservoirs[make] = Reservoir(max_rows_per_make, rng)
+                # Recode the chunk's models into the partition's own list of models
+                partition = partitions[make]
+                codes = chunk_codes[positions]
+                lookup = np.full(len(chunk_models), -1, dtype=np.int32)
+                for code in np.unique(codes[codes >= 0]):
+                    name = str(chunk_models[code])
+                    if name not in model_codes[make]:
+                        model_codes[make][name] = len(partition.models)
+                        partition.models.append(name)
+                    lookup[code] = model_codes[make][name]
+                columns = {'Year': chunk['Year'].to_numpy()[positions],
+                           'Miles': chunk['Miles'].to_numpy()[positions],
+                           'Price': chunk['Price'].to_numpy()[positions],
+                           'Model': np.where(codes >= 0, lookup[np.maximum(codes, 0)], -1).astype(np.int32)}
+                if max_rows_per_make is None:
+                    partition.append(columns)
+                else:
+                    reservoirs[make].add(columns)
+        for make, reservoir in reservoirs.items():
+            partitions[make].append(reservoir.columns)
+        listings = cls(directory, partitions, make_stats, year_stats,
+                       sample.columns or {'Miles': np.empty(0, dtype=np.int32), 'Price': np.empty(0, dtype=np.int32)})
+        listings.write_manifest()
+        return listings
+
+    def write_manifest(self):
+        np.save(os.path.join(self.directory, 'sample-miles.npy'), self.sample['Miles'])
+        np.save(os.path.join(self.directory, 'sample-price.npy'), self.sample['Price'])
+        manifest = {'partitions': [{'make': make, 'directory': os.path.basename(partition.directory),
+                                    'rows': partition.rows, 'models': partition.models}
+                                   for make, partition in self.partitions.items()],
+                    'make_stats': self.make_stats,
+                    'year_stats': [[year, stats] for year, stats in self.year_stats.items()]}
+        path = os.path.join(self.directory, self.manifest_name)
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, cls.manifest_name)) as manifest_file:
+            manifest = json.load(manifest_file)
+        partitions = {}
+        for record in manifest['partitions']:
+            partitions[record['make']] = Partition(os.path.join(directory, record['directory']), record['make'],
+                                                   record['rows'], record['models'])
+        sample = {'Miles': np.load(os.path.join(directory, 'sample-miles.npy')),
+                  'Price': np.load(os.path.join(directory, 'sample-price.npy'))}
+        return cls(directory, partitions, manifest['make_stats'],
+                   {year: stats for year, stats in manifest['year_stats']}, sample)
+
+    @staticmethod
+    def is_partitioned(path):
+        return os.path.isfile(os.path.join(path, PartitionedListings.manifest_name))
+
+    def makes(self):
+        return list(self.partitions)
+
+    def load(self, make):
+        # Rows of one make, or no rows for a make that is not in the listings
+        if make not in self.partitions:
+            return Partition(None, make, 0, []).frame({name: np.empty(0, dtype=dtype)
+                                                       for name, dtype in PARTITION_COLUMNS.items()})
+        return self.partitions[make].load()
+
+
+def load_listings(path='carvana.csv'):
+    # Open a directory built by PartitionedListings.build, or load a CSV like load_dataset
+    if PartitionedListings.is_partitioned(path):
+        return PartitionedListings.open(path)
+    return load_dataset(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split a listings CSV into per make partitions for out of core '
+                                                 'training')
+    parser.add_argument('csv', help='listings CSV in the carvana.csv format')
+    parser.add_argument('directory', help='directory to write the partitions to, used as --data afterwards')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows read from the CSV at a time')
+    parser.add_argument('--max-rows-per-make', type=int, help='keep a uniform sample of at most this many rows')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sampling')
+    args = parser.parse_args()
+    built = PartitionedListings.build(args.csv, args.directory, args.chunksize, args.max_rows_per_make, seed=args.seed)
+    print("wrote " + str(len(built.partitions)) + " partitions, " +
+          str(sum(len(partition) for partition in built.partitions.values())) + " rows, to " + args.directory)
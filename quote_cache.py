@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+from metrics import METRICS
+
+
+class QuoteCache:
+    # Results of recent quotes keyed by (year, make, model, mileage bucket), with the least recently used results
+    # evicted beyond max_entries. Every car in a mileage bucket is priced at the middle of the bucket, so with the
+    # default width of one mile the cache never changes a price. Results are dropped per make whenever a make's models
+    # or listings change.
+    def __init__(self, max_entries=10000, bucket_miles=1):
+        if bucket_miles < 1:
+            raise ValueError("bucket_miles must be at least 1")
+        self.max_entries = max_entries
+        self.bucket_miles = bucket_miles
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Keys of every make, so a make can be invalidated without scanning the whole cache
+        self.make_keys = {}
+        # Bumped on every invalidation of a make, so a quote computed before it is not stored after it
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, year, make, model, mileage):
+        return year, make, model, mileage // self.bucket_miles
+
+    def bucket_mileage(self, bucket):
+        # Mileage every car in the bucket is priced at
+        return bucket * self.bucket_miles + self.bucket_miles // 2
+
+    def generation(self, make):
+        return self.generations.get(make, 0)
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        METRICS.count('quote_cache', result is not None)
+        return result
+
+    def put(self, key, result, generation):
+        # Store a result computed while the make was at the given generation
+        make = key[1]
+        with self.lock:
+            if self.generations.get(make, 0) != generation:
+                return
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            self.make_keys.setdefault(make, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.make_keys[evicted[1]].discard(evicted)
+                self.evictions += 1
+
+    def invalidate_make(self, make):
+        with self.lock:
+            self.generations[make] = self.generations.get(make, 0) + 1
+            for key in self.make_keys.pop(make, ()):
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            for make in self.make_keys:
+                self.generations[make] = self.generations.get(make, 0) + 1
+            self.entries.clear()
+            self.make_keys = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'bucket_miles': self.bucket_miles,
+                    'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
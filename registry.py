@@ -0,0 +1,59 @@
+import pickle
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    # Fitted prediction models keyed by (make, with_model). Looking an entry up marks it as recently used, and the
+    # least recently used entries are evicted once the registry holds more than max_entries entries or more than
+    # roughly max_bytes bytes of fitted models.
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry_size(entry):
+        # The pickled size of the fitted model is a close estimate of its size in memory
+        return len(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __getitem__(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __setitem__(self, key, entry):
+        self.pop(key, None)
+        self.entries[key] = entry
+        if self.max_bytes is not None:
+            self.sizes[key] = ModelRegistry.entry_size(entry)
+            self.total_bytes += self.sizes[key]
+        # Evict the least recently used entries, but always keep the one just added
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self.pop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def pop(self, key, *default):
+        self.total_bytes -= self.sizes.pop(key, 0)
+        return self.entries.pop(key, *default)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def items(self):
+        return self.entries.items()
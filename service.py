@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import pandas as pd
+
+from main import add_policy_arguments, build_model, policy_from_arguments
+from metrics import METRICS
+from quote_cache import QuoteCache
+from validation import INSUFFICIENT_ERROR, input_error
+
+
+# Model loaded once in each worker process of a process pool
+worker_model = None
+# Traceback of an error raised while the worker loaded its model, reported when the service starts
+worker_error = None
+# Barrier every worker waits on while warming up
+worker_barrier = None
+
+
+def start_worker(data_path, lazy, metrics=False, policy=None, cache_size=0, bucket_miles=1, barrier=None):
+    # Load the dataset and models when a worker process starts, so every request finds them warm. The models were
+    # saved by the service process before the pool started, so workers only read the model cache and never write to
+    # it at the same time.
+    global worker_model, worker_error, worker_barrier
+    worker_barrier = barrier
+    METRICS.enable(metrics)
+    try:
+        worker_model = build_model(data_path, lazy, policy, quote_cache(cache_size, bucket_miles), read_only_cache=True)
+    except Exception:
+        worker_error = traceback.format_exc()
+    METRICS.reset()
+
+
+def quote_cache(cache_size, bucket_miles):
+    # A QuoteCache of cache_size results, or None to turn the cache off
+    return QuoteCache(cache_size, bucket_miles) if cache_size else None
+
+
+def invalid_field(car):
+    # Name of the first of a car's fields that is neither a string nor a number, or None when they all are. Missing
+    # fields are fine, they get the same defaults as empty fields in the window.
+    for name in ('year', 'make', 'model', 'miles'):
+        value = car.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+            return name
+    return None
+
+
+def car_fields(car):
+    # Year, make, model and miles of a car given as a JSON object, with the defaults of the window's empty fields
+    return car.get('year', "Year"), car.get('make', "Make"), car.get('model') or "Not listed", car.get('miles', "")
+
+
+def quote_car(model, car):
+    # Quote one car given as a JSON object with year, make, model and miles
+    return model.quote(*car_fields(car))
+
+
+def quote_cars(model, cars):
+    # Quote a list of cars with one vectorized predict per make. Every car gets the same result, error messages
+    # included, as quoting it on its own.
+    fields = [car_fields(car) for car in cars]
+    frame = pd.DataFrame(fields, columns=['Year', 'Make', 'Model', 'Miles'], dtype=object)
+    quotes = model.calculate_listing_prices(frame)
+    results = []
+    for car, price, confidence in zip(fields, quotes['Predicted Price'], quotes['Confidence']):
+        error = input_error(*car)
+        if error is not None:
+            results.append({'error': error})
+        elif pd.isna(price):
+            # Cars of makes without a prediction model, or still training
+            results.append({'error': INSUFFICIENT_ERROR if confidence == "no model" else confidence})
+        else:
+            results.append({'price': int(price), 'confidence': confidence})
+    return results
+
+
+def collect_worker_metrics(result):
+    # Send the metrics a worker recorded for one request back with its result, so the service can add them up
+    if not METRICS.enabled:
+        return result, None
+    snapshot = METRICS.snapshot()
+    METRICS.reset()
+    return result, snapshot
+
+
+def quote_car_in_worker(car):
+    return collect_worker_metrics(quote_car(worker_model, car))
+
+
+def quote_cars_in_worker(cars):
+    return collect_worker_metrics(quote_cars(worker_model, cars))
+
+
+def warm_worker(_):
+    # Wait until every worker has loaded its model, so each worker takes exactly one of these calls, and report
+    # whether it succeeded
+    worker_barrier.wait()
+    return os.getpid(), worker_error
+
+
+class PricingService:
+    # Minimal HTTP/1.1 JSON server. Requests are parsed on the event loop and the CPU bound predictions run on an
+    # executor, so the loop keeps accepting connections while models are predicting.
+    #   GET  /health  -> {"status": "ok"}
+    #   POST /quote   {"year", "make", "model", "miles"} -> {"price", "confidence"} or {"error"}
+    #   POST /quotes  {"cars": [...]} -> {"quotes": [...]}
+    #   GET  /metrics -> stage timings and cache counters as Prometheus text, or JSON with ?format=json
+    def __init__(self, executor, model=None):
+        self.executor = executor
+        # With a thread pool the model is shared, with a process pool every worker has its own copy
+        self.model = model
+
+    async def run_in_worker(self, function, argument):
+        # Run a worker function on the process pool and add the metrics it recorded to this process's metrics
+        loop = asyncio.get_running_loop()
+        result, snapshot = await loop.run_in_executor(self.executor, function, argument)
+        if snapshot is not None:
+            METRICS.merge(snapshot)
+        return result
+
+    async def run_quote(self, car):
+        if self.model is None:
+            return await self.run_in_worker(quote_car_in_worker, car)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(quote_car, self.model, car))
+
+    async def run_quotes(self, cars):
+        if self.model is None:
+            return await self.run_in_worker(quote_cars_in_worker, cars)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(quote_cars, self.model, cars))
+
+    async def dispatch(self, method, path, body, query=''):
+        # Route a request and return (status, payload). A string payload is sent as plain text.
+        if path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if path == '/metrics':
+            if query == 'format=json':
+                return '200 OK', METRICS.snapshot()
+            return '200 OK', METRICS.to_prometheus()
+        if path not in ('/quote', '/quotes'):
+            return '404 Not Found', {'error': "unknown path " + path}
+        if method != 'POST':
+            return '405 Method Not Allowed', {'error': "use POST"}
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return '400 Bad Request', {'error': "body must be JSON"}
+        if path == '/quote':
+            if not isinstance(request, dict):
+                return '400 Bad Request', {'error': "expected a JSON object"}
+            if invalid_field(request) is not None:
+                return '400 Bad Request', {'error': invalid_field(request) + " must be a string or a number"}
+            return '200 OK', await self.run_quote(request)
+        cars = request.get('cars') if isinstance(request, dict) else None
+        if not isinstance(cars, list) or not all(isinstance(car, dict) for car in cars):
+            return '400 Bad Request', {'error': "expected {\"cars\": [...]}"}
+        for position, car in enumerate(cars):
+            if invalid_field(car) is not None:
+                return '400 Bad Request', {'error': "cars[" + str(position) + "]." + invalid_field(car) +
+                                                    " must be a string or a number"}
+        return '200 OK', {'quotes': await self.run_quotes(cars)}
+
+    async def handle_connection(self, reader, writer):
+        # Serve requests on one connection until the client closes it or asks to
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path, _, query = path.partition('?')
+                status, payload = await self.dispatch(method, path, body, query)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, str):
+                    data = payload.encode()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    data = json.dumps(payload).encode()
+                    content_type = 'application/json'
+                writer.write(('HTTP/1.1 ' + status + '\r\n'
+                              'Content-Type: ' + content_type + '\r\n'
+                              'Content-Length: ' + str(len(data)) + '\r\n'
+                              'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n').encode()
+                             + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Malformed requests and dropped connections just close the connection
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving car price quotes on http://" + host + ":" + str(port))
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Car sale price quote service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data', default='carvana.csv',
+                        help='dataset used to train the models, a CSV or a partitioned directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='size of the prediction pool')
+    parser.add_argument('--processes', action='store_true',
+                        help='predict on a pool of processes that each hold the models, instead of threads')
+    parser.add_argument('--lazy', action='store_true', help='train each make on its first quote')
+    parser.add_argument('--metrics', action='store_true', help='record stage timings and cache counters for /metrics')
+    parser.add_argument('--quote-cache', type=int, default=10000, help='quote results to cache, 0 turns it off')
+    parser.add_argument('--bucket-miles', type=int, default=1,
+                        help='width of the mileage buckets that share a cached quote')
+    add_policy_arguments(parser)
+    args = parser.parse_args(argv)
+
+    METRICS.enable(args.metrics)
+    if args.processes:
+        if not args.lazy:
+            # Train or reload the models once, saving them to the model cache the workers reload them from
+            build_model(args.data, False, policy_from_arguments(args))
+        barrier = multiprocessing.Barrier(args.workers)
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=start_worker,
+                                       initargs=(args.data, args.lazy, args.metrics, policy_from_arguments(args),
+                                                 args.quote_cache, args.bucket_miles, barrier))
+        # Start every worker and load its models before accepting requests
+        errors = [error for _, error in executor.map(warm_worker, range(args.workers)) if error is not None]
+        if errors:
+            executor.shutdown(cancel_futures=True)
+            raise SystemExit("A worker failed to load the models:\n" + errors[0])
+        service = PricingService(executor)
+    else:
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        service = PricingService(executor, build_model(args.data, args.lazy, policy_from_arguments(args),
+                                                       quote_cache(args.quote_cache, args.bucket_miles)))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+    main()
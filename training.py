@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from encoder import FeatureEncoder
+from forest import PickledRegressor, TreeEnsemble
+from metrics import METRICS
+from partitions import Partition
+
+
+class InsufficientData(Exception):
+    # Raised when a make has too few rows left to split into training and testing sets
+    pass
+
+
+def rate_score(score):
+    # Assign a confidence metric to an r2 score
+    if score < 0:
+        return "negative"
+    elif score < 0.3:
+        return "weak"
+    elif score <= 0.7:
+        return "moderate"
+    return "strong"
+
+
+def training_policy(early_stopping=True, validation_fraction=0.1, n_iter_no_change=10, min_rows=100,
+                    make_seconds=None, total_seconds=None, min_stages=10):
+    # How the per make models are fitted.
+    #   early_stopping: hold out validation_fraction of a make's training rows and stop adding stages once the
+    #       validation loss has not improved for n_iter_no_change stages. Makes with fewer than min_rows training
+    #       rows are too small for a useful validation split and always fit every stage.
+    #   make_seconds: stop adding stages to one model after this many seconds of fitting
+    #   total_seconds: stop adding stages to every model once this many seconds have passed since the training run
+    #       started. Models fitted after that still get min_stages stages.
+    return {'early_stopping': early_stopping, 'validation_fraction': validation_fraction,
+            'n_iter_no_change': n_iter_no_change, 'min_rows': min_rows, 'make_seconds': make_seconds,
+            'total_seconds': total_seconds, 'min_stages': min_stages}
+
+
+class TimeBudget:
+    # fit() monitor that stops adding stages once a model's time budget or the training run's deadline has passed
+    def __init__(self, make_seconds=None, deadline=None, min_stages=10):
+        self.make_seconds = make_seconds
+        # Wall clock time, shared by every worker process of the run
+        self.deadline = deadline
+        self.min_stages = min_stages
+        self.start = time.perf_counter()
+
+    def __call__(self, stage, regressor, local_variables):
+        if stage + 1 < self.min_stages:
+            return False
+        if self.make_seconds is not None and time.perf_counter() - self.start > self.make_seconds:
+            return True
+        return self.deadline is not None and time.time() > self.deadline
+
+
+def drop_outliers(df_maker):
+    # Remove outlier prices
+    mean = df_maker["Price"].mean()
+    deviation = df_maker["Price"].std()
+    return df_maker[(df_maker['Year'] <= mean + (3*deviation))]
+
+
+def fit_gradient_boost(rows, model, params, policy=None):
+    # Generate a gradient boost regression model from the rows of one make, following the training policy if given
+    # Returns the fitted regressor, its r2 score, the encoder that turns cars into its features and the fit time
+    # sklearn is imported here rather than with the module, so processes that only quote never load it
+    from sklearn.ensemble import GradientBoostingRegressor
+    from sklearn.metrics import r2_score
+    from sklearn.model_selection import train_test_split
+    if model:
+        # Generate a prediction model that includes "model" data
+        # Fit an encoder for the model column and encode the rows as a matrix
+        with METRICS.stage('encode', len(rows)):
+            rows = drop_outliers(rows)
+            encoder = FeatureEncoder.fit(rows, True)
+            x = encoder.transform(rows['Year'], rows['Miles'], rows['Model'])
+    else:
+        # Generate a prediction model that does not include "model" data
+        encoder = FeatureEncoder.fit(rows, False)
+        x = encoder.transform(rows['Year'], rows['Miles'])
+    # Define dependent and independent variables
+    y = rows['Price'].to_numpy()
+    if len(y) < 2:
+        # One row can't be split, and a make whose only row is dropped as an outlier has none
+        raise InsufficientData(str(len(y)) + " rows")
+    # Split the data into training and testing sets
+    with METRICS.stage('train_test_split', len(x)):
+        X_train, X_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
+    # Create and train the Gradient Boosting model
+    settings = dict(params)
+    monitor = None
+    if policy is not None:
+        if policy['early_stopping'] and len(X_train) >= policy['min_rows']:
+            settings.update(n_iter_no_change=policy['n_iter_no_change'],
+                            validation_fraction=policy['validation_fraction'])
+        if policy['make_seconds'] is not None or policy.get('deadline') is not None:
+            monitor = TimeBudget(policy['make_seconds'], policy.get('deadline'), policy['min_stages'])
+    regressor = GradientBoostingRegressor(**settings)
+    start = time.perf_counter()
+    with METRICS.stage('fit', len(X_train)):
+        regressor.fit(X_train, y_train, monitor=monitor)
+    fit_seconds = time.perf_counter() - start
+    # Test the prediction model
+    with METRICS.stage('evaluate', len(X_test)):
+        y_pred = regressor.predict(X_test)
+    # Get the model's r2 score
+    r2 = r2_score(y_test, y_pred)
+    return [regressor, r2, encoder, fit_seconds]
+
+
+def train_job(make, model, rows, params, policy=None):
+    # Train one (make, with_model) job and return its registry entry, or None when the make has insufficient data.
+    # rows is a frame or a Partition, which is only read here so a worker process holds one make at a time.
+    if isinstance(rows, Partition):
+        rows = rows.load()
+    # Load sklearn before warnings become errors, so a warning raised while it imports isn't taken for a make with
+    # insufficient data and saved to the cache as one
+    import sklearn.ensemble
+    import sklearn.metrics
+    import sklearn.model_selection
+    with warnings.catch_warnings(), METRICS.stage('train_job', len(rows)):
+        warnings.filterwarnings('error')
+        try:
+            results = fit_gradient_boost(rows, model, params, policy)
+        except (Warning, InsufficientData):
+            # Makes with insufficient entries for an accurate prediction model are left out of the registry
+            return None
+    # Save the encoder so new cars are encoded the same way as the training rows
+    encoder = results[2]
+    # Save the fitted trees as numpy arrays, which predict the same prices as the regressor without needing sklearn,
+    # and the regressor itself for large batches, where sklearn is faster
+    trees = TreeEnsemble.from_gradient_boost(results[0])
+    # Save the number of boosting stages actually fitted and the fit time next to the score
+    return {'regressor': trees, 'batch_regressor': PickledRegressor(results[0]), 'encoder': encoder,
+            'columns': encoder.columns, 'r2': results[1], 'rating': rate_score(results[1]),
+            'stages': int(results[0].n_estimators_), 'fit_seconds': results[3]}
+
+
+def measured_train_job(make, model, rows, params, policy=None):
+    # train_job in a worker process, returning the entry with the metrics recorded while training it
+    METRICS.enable()
+    METRICS.reset()
+    entry = train_job(make, model, rows, params, policy)
+    return entry, METRICS.snapshot()
+
+
+class TrainingScheduler:
+    # Spreads (make, with_model) training jobs over a pool of worker processes
+    def __init__(self, workers=None):
+        # None uses every core, 1 trains serially in this process
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, jobs, params, policy=None):
+        # Train a list of (make, model, rows) jobs and yield ((make, model), entry) as each one finishes
+        # The biggest makes go first so a long job started last does not leave the other workers idle
+        jobs = sorted(jobs, key=lambda job: len(job[2]), reverse=True)
+        if policy is not None and policy['total_seconds'] is not None:
+            # The total budget becomes a deadline every job checks, whichever process it runs in
+            policy = dict(policy, deadline=time.time() + policy['total_seconds'])
+        if self.workers == 1 or len(jobs) <= 1:
+            for make, model, rows in jobs:
+                yield (make, model), train_job(make, model, rows, params, policy)
+            return
+        # Spawned workers do not inherit the state of the parent, such as a running Tk interpreter
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)), mp_context=context) as pool:
+            # Worker processes have their own metrics, which are sent back with each entry when instrumentation is on
+            job = measured_train_job if METRICS.enabled else train_job
+            futures = {pool.submit(job, make, model, rows, params, policy): (make, model)
+                       for make, model, rows in jobs}
+            for future in as_completed(futures):
+                entry = future.result()
+                if METRICS.enabled:
+                    entry, snapshot = entry
+                    METRICS.merge(snapshot)
+                yield futures[future], entry
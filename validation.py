@@ -0,0 +1,51 @@
+import numpy as np
+
+# Errors of a quote, shared by every way of quoting a car
+MILEAGE_ERROR = "Mileage must be numbers only"
+INCOMPLETE_ERROR = "fields not complete"
+YEAR_ERROR = "Year must be numbers only"
+INSUFFICIENT_ERROR = "insufficient data for this make"
+
+
+def whole_number(value):
+    # A year or mileage as an int, or None unless it is a non-negative whole number. Text must be digits only, like
+    # the window's entry fields.
+    if isinstance(value, str):
+        return int(value) if value.isascii() and value.isdigit() else None
+    if isinstance(value, (bool, np.bool_)):
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value) if value >= 0 else None
+    if isinstance(value, (float, np.floating)) and np.isfinite(value) and value >= 0 and float(value).is_integer():
+        return int(value)
+    return None
+
+
+def whole_numbers(values):
+    # whole_number of every value of a column, as floats with NaN for the values that are not whole numbers.
+    # Numeric columns are checked without a Python loop.
+    import pandas as pd
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numbers = values.to_numpy(dtype=float, na_value=np.nan, copy=True)
+        with np.errstate(invalid='ignore'):
+            numbers[~((numbers >= 0) & (numbers % 1 == 0))] = np.nan
+        return numbers
+    numbers = np.full(len(values), np.nan)
+    for position, value in enumerate(values):
+        number = whole_number(value)
+        if number is not None:
+            numbers[position] = number
+    return numbers
+
+
+def input_error(year, make, model, mileage):
+    # The error a quote of these fields gets before any model is looked up, or None when they can be priced
+    if whole_number(mileage) is None:
+        return MILEAGE_ERROR
+    if (year == "Year") or (make == "Make") or (model == "Model"):
+        # Check if each input field has a valid entry
+        return INCOMPLETE_ERROR
+    if whole_number(year) is None:
+        return YEAR_ERROR
+    return None
@@ -1,6 +1,69 @@
 import tkinter as tk
 from tkinter import ttk
 
+# Keys that move around a combobox or its list rather than change the text, which don't filter its values
+NAVIGATION_KEYS = {'Up', 'Down', 'Left', 'Right', 'Return', 'KP_Enter', 'Escape', 'Tab', 'Home', 'End', 'Prior',
+                   'Next', 'Shift_L', 'Shift_R', 'Control_L', 'Control_R', 'Alt_L', 'Alt_R'}
+
+
+class HistoryTable(ttk.Frame):
+    # A Treeview that only holds the rows on screen. The rows are read from a source when they scroll into view and a
+    # scrollbar stands for the whole history, so the table stays responsive however many quotes it holds.
+    def __init__(self, parent, columns, height=10):
+        super().__init__(parent)
+        # Number of rows in the source and the function that returns rows start to stop - 1 of it
+        self.count = 0
+        self.fetch = None
+        # Position of the first row on screen
+        self.top = 0
+        self.height = height
+        self.tree = ttk.Treeview(self, columns=[name for name, _ in columns], show='headings', height=height)
+        for name, width in columns:
+            self.tree.column(name, anchor=tk.W, width=width)
+            self.tree.heading(name, text=name, anchor=tk.W)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.scroll)
+        self.tree.grid(row=0, column=0)
+        self.scrollbar.grid(row=0, column=1, sticky=tk.NS)
+        self.tree.bind('<MouseWheel>', self.wheel_turned)
+        # X11 reports the wheel as buttons 4 and 5
+        self.tree.bind('<Button-4>', lambda event: self.scroll('scroll', -1, 'units'))
+        self.tree.bind('<Button-5>', lambda event: self.scroll('scroll', 1, 'units'))
+
+    def set_source(self, count, fetch):
+        self.fetch = fetch
+        self.show_latest(count)
+
+    def show_latest(self, count):
+        # Scroll to the end of a source that now has count rows
+        self.count = count
+        self.top = max(0, count - self.height)
+        self.render()
+
+    def scroll(self, action, amount, unit=None):
+        # Scrollbar command: ('moveto', fraction) or ('scroll', steps, 'units' or 'pages')
+        if action == 'moveto':
+            top = int(float(amount) * self.count)
+        else:
+            top = self.top + int(amount) * (self.height if unit == 'pages' else 1)
+        top = max(0, min(top, self.count - self.height))
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def wheel_turned(self, event):
+        self.scroll('scroll', -1 if event.delta > 0 else 1, 'units')
+
+    def render(self):
+        # Replace the rows on screen with the window starting at top
+        self.tree.delete(*self.tree.get_children())
+        rows = self.fetch(self.top, self.top + self.height) if self.fetch is not None else []
+        for number, row in enumerate(rows, start=self.top + 1):
+            self.tree.insert('', 'end', values=[str(number)] + list(row))
+        if self.count:
+            self.scrollbar.set(self.top / self.count, (self.top + len(rows)) / self.count)
+        else:
+            self.scrollbar.set(0, 1)
+
 
 class View(ttk.Frame):
     def __init__(self, parent):
@@ -8,11 +71,16 @@ class View(ttk.Frame):
 
         # Controller
         self.controller = None
+        # Graph widget currently on screen
+        self.graph = None
 
         # Instructions label
         self.instructions = ttk.Label(self, text="Select the year, make, model, and miles to generate a price",
                                       font=('verdana', 12))
         self.instructions.grid(row=0, column=0, columnspan=3, pady=10, padx=30, sticky=tk.W)
+        # Training progress label
+        self.status_label = ttk.Label(self, text="", font=('verdana', 10))
+        self.status_label.grid(row=0, column=3, columnspan=2, padx=5, sticky=tk.W)
         # Predicted price label
         self.price_label = ttk.Label(self, text='Suggested sale price: ', font=('verdana', 12))
         self.price_label.grid(row=2, column=0, columnspan=2, padx=30, sticky=tk.W)
@@ -41,6 +109,9 @@ class View(ttk.Frame):
         # Model accuracy button
         self.accuracy_button = ttk.Button(self, text='Model Accuracy', command=self.accuracy_button_clicked)
         self.accuracy_button.grid(row=5, column=3, padx=10, sticky=tk.W)
+        # Metrics button
+        self.metrics_button = ttk.Button(self, text='Metrics', command=self.metrics_button_clicked)
+        self.metrics_button.grid(row=5, column=4, padx=10, sticky=tk.W)
 
         # Year combobox
         self.year_menu = ttk.Combobox(self, values=['Year'])
@@ -52,12 +123,14 @@ class View(ttk.Frame):
         self.make_menu = ttk.Combobox(self, values=['Make'])
         self.make_menu.set("Make")
         self.make_menu.bind("<<ComboboxSelected>>", self.make_combo_clicked)
+        self.make_menu.bind("<KeyRelease>", self.make_typed)
         self.make_menu.config(width=20)
         self.make_menu.grid(row=1, column=1, padx=5, sticky=tk.W)
 
         # Model combobox
         self.model_menu = ttk.Combobox(self, values=['Model'])
         self.model_menu.set("Model")
+        self.model_menu.bind("<KeyRelease>", self.model_typed)
         self.model_menu.config(width=20)
         self.model_menu.grid(row=1, column=2, padx=5, sticky=tk.W)
 
@@ -69,24 +142,9 @@ class View(ttk.Frame):
         self.mileage_entry.config(width=20)
         self.mileage_entry.grid(row=1, column=3, padx=5, sticky=tk.W)
 
-        # Table for displaying price calculations
-        self.table = ttk.Treeview(self)
-        self.table['columns'] = ('Entry ID', 'Year', 'Make', 'Model', 'Mileage', 'Price')
-        self.id_num = 1
-        self.table.column("#0", width=0, stretch=tk.NO)
-        self.table.column("Entry ID", anchor=tk.W, width=50)
-        self.table.column("Year", anchor=tk.W, width=80)
-        self.table.column("Make", anchor=tk.W, width=80)
-        self.table.column("Model", anchor=tk.W, width=80)
-        self.table.column("Mileage", anchor=tk.W, width=80)
-        self.table.column("Price", anchor=tk.W, width=110)
-        self.table.heading('#0', text="Label", anchor=tk.W)
-        self.table.heading('Entry ID', text="Entry ID", anchor=tk.W)
-        self.table.heading("Year", text="Year", anchor=tk.W)
-        self.table.heading("Make", text="Make", anchor=tk.W)
-        self.table.heading("Model", text="Model", anchor=tk.W)
-        self.table.heading("Mileage", text="Mileage", anchor=tk.W)
-        self.table.heading("Price", text="Price", anchor=tk.W)
+        # Table of every price calculated, kept in the quote history file
+        self.table = HistoryTable(self, [('Entry ID', 50), ('Year', 80), ('Make', 80), ('Model', 80),
+                                         ('Mileage', 80), ('Price', 110)])
         self.table.grid(row=3, column=0, columnspan=6, pady=25)
 
     def set_controller(self, controller):
@@ -99,29 +157,36 @@ class View(ttk.Frame):
             model = self.model_menu.get()
             mileage = self.mileage_entry.get()
             prediction = self.controller.generate_price(year, make, model, mileage)
-            if (prediction == "Error: fields not complete") or (prediction == "Error: Mileage must be numbers only"):
+            if not prediction.startswith("$"):
+                # Errors, and makes whose models are still training
                 self.sale_price_label.config(text=prediction)
                 return
             else:
                 self.sale_price_label.config(text=prediction)
-                self.table.insert('', 'end', iid=str(self.id_num), text='Parent',
-                                  values=(str(self.id_num), year, make, model, mileage, prediction))
-                self.id_num += 1
+                self.table.show_latest(self.controller.record_quote(year, make, model, mileage, prediction))
+
+    def show_status(self, text):
+        self.status_label.config(text=text)
+
+    def show_graph(self, canvas):
+        # Hide the graph on screen and show the new one in its place
+        graph = canvas.get_tk_widget()
+        if self.graph is not None and self.graph is not graph:
+            self.graph.grid_remove()
+        graph.grid(column=0, row=6, pady=20, columnspan=8)
+        self.graph = graph
 
     def graph_one_button_clicked(self):
         if self.controller:
-            g_one = self.controller.load_graph_one().get_tk_widget()
-            g_one.grid(column=0, row=6, pady=20, columnspan=8)
+            self.show_graph(self.controller.load_graph_one())
 
     def graph_two_button_clicked(self):
         if self.controller:
-            g_two = self.controller.load_graph_two().get_tk_widget()
-            g_two.grid(column=0, row=6, pady=20, columnspan=8)
+            self.show_graph(self.controller.load_graph_two())
 
     def graph_three_button_clicked(self):
         if self.controller:
-            g_three = self.controller.load_graph_three().get_tk_widget()
-            g_three.grid(column=0, row=6, pady=20, columnspan=8)
+            self.show_graph(self.controller.load_graph_three())
 
     def accuracy_button_clicked(self):
         if self.controller:
@@ -134,11 +199,32 @@ class View(ttk.Frame):
                 report_text.insert(tk.END, new_line)
             report_text.grid(column=0, row=0, pady=20)
 
+    def metrics_button_clicked(self):
+        # Stage timings and cache hit rates recorded since the app started
+        if self.controller:
+            newWindow = tk.Toplevel()
+            newWindow.title("Metrics")
+            newWindow.geometry("800x600")
+            metrics_text = tk.Text(newWindow, width=100, height=40)
+            for line in self.controller.load_metrics():
+                metrics_text.insert(tk.END, line + "\n")
+            metrics_text.grid(column=0, row=0, pady=20)
+
     def populate_combobox(self, data, combobox):
+        # Set every value in one call
         if self.controller:
-            combobox.configure(value=())
-            for item in data:
-                combobox['values'] = tuple(list(combobox['values']) + [str(item)])
+            combobox['values'] = [str(item) for item in data]
+
+    def make_typed(self, event):
+        # Narrow the makes to the ones starting with the text typed so far
+        if self.controller and event.keysym not in NAVIGATION_KEYS:
+            self.populate_combobox(self.controller.search_makes(self.make_menu.get()), self.make_menu)
+
+    def model_typed(self, event):
+        # Narrow the models of the selected make to the ones starting with the text typed so far
+        if self.controller and event.keysym not in NAVIGATION_KEYS:
+            self.populate_combobox(self.controller.search_models(self.make_menu.get(), self.model_menu.get()),
+                                   self.model_menu)
 
     def make_combo_clicked(self, event):
         # Update the "Models" combobox with models corresponding to the selected make